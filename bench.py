@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import sys
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame  # noqa: E402
+
+from lb.benchmark import (  # noqa: E402
+    PATTERNS, SESSIONS, compare_to_baseline, print_comparison, print_micro_summary, print_summary, print_tick_summary,
+    run_display_sessions, run_micro_benchmarks, run_tick_sessions,
+)
+from lb.simulation import create_app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the display and engine on synthetic sessions')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--ticks', type=int, default=0, help='also step the sequencer clock this many ticks and check it does not allocate')
+    parser.add_argument('--session', action='append', choices=list(SESSIONS))
+    parser.add_argument('--micro', action='store_true', help='also run the engine micro benchmarks')
+    parser.add_argument('--pattern', action='append', choices=list(PATTERNS), help='synthetic pattern sizes for --micro')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results previously written with --json and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='slowdown ratio over the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=256)
+    # Virtual time keeps the clock and I/O threads from running during measurements
+    app = create_app()
+
+    summaries = {}
+    if args.frames:
+        summaries = run_display_sessions(app, sessions=args.session, frames=args.frames)
+    for name, summary in summaries.items():
+        print_summary(name, summary)
+
+    tick_summaries = {}
+    if args.ticks:
+        tick_summaries = run_tick_sessions(app, sessions=args.session, ticks=args.ticks)
+        for name, summary in tick_summaries.items():
+            print_tick_summary(name, summary)
+
+    micro = {}
+    if args.micro:
+        micro = run_micro_benchmarks(app, patterns=args.pattern)
+        print_micro_summary(micro)
+
+    results = {'display': summaries, 'ticks': tick_summaries, 'micro': micro}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare_to_baseline(results, json.load(f), threshold=args.threshold)
+        print_comparison(rows)
+        regressions = [row[0] for row in rows if row[4]]
+
+    if any(s['quiet_allocating'] for s in tick_summaries.values()):
+        sys.exit('Quiet clock ticks allocated memory')
+    if any(s['stuck_notes'] for s in tick_summaries.values()):
+        sys.exit('Notes were left stuck on')
+    if regressions:
+        sys.exit(f'{len(regressions)} benchmarks regressed more than {args.threshold:.0%} against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,26 @@
+import atexit
 import json
 import logging
 import math
 import os
 import threading
+import time
+import traceback
 from collections import defaultdict
+from .boot import BootTimeline
+from .control_server import ControlServer
 from .controls import Controls
 from .input_manager import InputManager
 from .output_manager import OutputManager
+from .reactor import Reactor
 from .sequencer import Sequencer
 from .tempo import Tempo
-from .display import Display
-from .util import number_to_note, list_next, list_prev
+from .journal import JournalRecorder
+from . import locks, log, metrics
+from .locks import make_lock
+from .runtime import Runtime
+from .timesource import RealTimeSource
+from .util import IndexedOptions, number_to_note, list_next, list_prev, list_step, rotary_acceleration
 
 
 class MetronomeParam:
@@ -19,7 +29,7 @@ class MetronomeParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = [False, True]
+        self.options = IndexedOptions([False, True])
 
     def get(self):
         return self.app.tempo.enable_metronome
@@ -43,7 +53,7 @@ class QuantizerParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = [1, 2, 4, 8, 16, 32, None]
+        self.options = IndexedOptions([1, 2, 4, 8, 16, 32, None])
 
     def get(self):
         return self.app.selected_sequencer.quantizer_filter.divisor
@@ -70,7 +80,7 @@ class GateLengthParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = [x / 10 for x in range(1, 9)] + [math.sqrt(x / 10) for x in range(10, 170, 8)]
+        self.options = IndexedOptions([x / 10 for x in range(1, 9)] + [math.sqrt(x / 10) for x in range(10, 170, 8)])
 
     def get(self):
         return self.app.selected_sequencer.gate_length_filter.multiplier
@@ -95,7 +105,7 @@ class OffsetParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = [x / 10 for x in range(-10, 11)]
+        self.options = IndexedOptions([x / 10 for x in range(-10, 11)])
 
     def get(self):
         return self.app.selected_sequencer.offset_filter.offset
@@ -122,7 +132,7 @@ class LengthParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(1, 17))
+        self.options = IndexedOptions(range(1, 17))
 
     def get(self):
         return self.app.selected_sequencer.bars
@@ -140,13 +150,61 @@ class LengthParam:
         return f'{v} bars'
 
 
+class ZoomParam:
+    name = 'Zoom'
+    type = 'list'
+
+    def __init__(self, app):
+        self.app = app
+        self.options = IndexedOptions([1, 2, 4, 8, 16])
+
+    def get(self):
+        return self.app.selected_sequencer.zoom
+
+    def set(self, v):
+        self.app.selected_sequencer.zoom = v
+
+    def ok(self):
+        self.set(1)
+
+    def is_on(self):
+        return self.get() != 1
+
+    def to_str(self, v):
+        return f'{v}x'
+
+
+class ScrollParam:
+    name = 'Scroll'
+    type = 'dial'
+
+    def __init__(self, app):
+        self.app = app
+        self.options = IndexedOptions([None] + list(range(16)))
+
+    def get(self):
+        return self.app.selected_sequencer.scroll
+
+    def set(self, v):
+        self.app.selected_sequencer.scroll = v
+
+    def ok(self):
+        self.set(None)
+
+    def is_on(self):
+        return self.get() is not None
+
+    def to_str(self, v):
+        return 'Follow' if v is None else f'Bar {v + 1}'
+
+
 class TempoParam:
     name = 'Tempo'
     type = 'dial'
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(60, 201))
+        self.options = IndexedOptions(range(60, 201))
 
     def get(self):
         return self.app.input_manager.internal_clock.bpm
@@ -170,7 +228,7 @@ class InputChannelParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = [None] + list(range(1, 17))
+        self.options = IndexedOptions([None] + list(range(1, 17)))
 
     def get(self):
         return self.app.selected_sequencer.input_channel
@@ -194,7 +252,7 @@ class OutputChannelParam:
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(1, 17))
+        self.options = IndexedOptions(range(1, 17))
 
     def get(self):
         return self.app.selected_sequencer.output_channel
@@ -228,19 +286,19 @@ class NotePitchParam(BaseNoteParam):
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(128))
+        self.options = IndexedOptions(range(128))
 
     def get(self):
         on, _ = self._get_events()
         if on:
-            return on.message.note
+            return on.note
         return 0
 
     def set(self, v):
         on, off = self._get_events()
         if on:
-            on.message.note = v
-            off.message.note = v
+            on.note = v
+            off.note = v
         self.app.selected_sequencer.refresh()
 
     def ok(self):
@@ -260,7 +318,7 @@ class NoteLengthParam(BaseNoteParam):
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(0, 32 * 16))
+        self.options = IndexedOptions(range(0, 32 * 16))
 
     def get(self):
         on, off = self._get_events()
@@ -290,18 +348,18 @@ class NoteVelocityParam(BaseNoteParam):
 
     def __init__(self, app):
         self.app = app
-        self.options = list(range(128))
+        self.options = IndexedOptions(range(128))
 
     def get(self):
         on, _ = self._get_events()
         if on:
-            return on.message.velocity
+            return on.velocity
         return 0
 
     def set(self, v):
         on, _ = self._get_events()
         if on:
-            on.message.velocity = v
+            on.velocity = v
         self.app.selected_sequencer.refresh()
 
     def ok(self):
@@ -338,6 +396,14 @@ class PatternParamGroup:
         self.param2 = None
 
 
+class ViewParamGroup:
+    name = 'View'
+
+    def __init__(self, app):
+        self.param1 = ZoomParam(app)
+        self.param2 = ScrollParam(app)
+
+
 class MIDIParamGroup:
     name = 'MIDI'
 
@@ -371,18 +437,37 @@ class VelocityParamGroup:
 
 
 class App:
-    def __init__(self):
-        self.input_manager = InputManager(self)
-        self.output_manager = OutputManager()
-        self.controls = Controls(self)
-        self.tempo = Tempo(self)
-
-        self.input_manager.start()
-        self.output_manager.start()
-        self.controls.start()
-        self.tempo.start()
-
-        self.saved_state_path = 'state.json'
+    def __init__(self, headless=False, state_path='state.json', framebuffer=None, gpio=None, journal=None, time_source=None, runtime=None, ui=True, metronome=True, control_socket=None, boot=None):
+        self.time_source = time_source or RealTimeSource()
+        self.runtime = runtime or Runtime()
+        self.boot = boot or BootTimeline()
+        with self.boot.phase('engine'):
+            self.reactor = Reactor(self)
+            self.input_manager = InputManager(self)
+            self.output_manager = OutputManager(self)
+            self.controls = Controls(self, gpio=gpio if ui else False)
+            self.tempo = Tempo(self, metronome=metronome)
+
+        # Without a UI the display and controls live in another process, see lb.split
+        self.display = None
+        if ui:
+            with self.boot.phase('display'):
+                from .display import Display
+                from .framebuffer import FramebufferOutput
+                output = FramebufferOutput(framebuffer) if framebuffer else None
+                self.display = Display(self, headless=headless, output=output)
+            self.boot.start('assets', self.display.load_assets)
+
+        # Under a virtual time source the caller drives the clock, so the engine threads stay idle
+        if not self.time_source.virtual:
+            self.reactor.start()
+            # MIDI ports are opened by the input and output polling threads, in parallel with the rest of the boot
+            self.input_manager.start()
+            self.output_manager.start()
+            self.controls.start()
+            self.tempo.start()
+
+        self.saved_state_path = state_path
         self.selected_sequencer = None
         self.selected_sequencer_bank = 0
         self.seleted_event = None
@@ -397,7 +482,10 @@ class App:
             self.sequencers.append(s)
             s.output.subscribe(lambda msg: self.output_manager.send_to_all(msg))
 
-        self.state_file_lock = threading.RLock()
+        self.state_file_lock = make_lock('App.state_file_lock')
+        self.pending_values_lock = make_lock('App.pending_values_lock', reentrant=False)
+        self.pending_values = {}
+        self.last_value_step = {}
         self.enable_state_saving = False
 
         self.select_sequencer(self.sequencers[0])
@@ -406,14 +494,9 @@ class App:
 
         if False:
             for i in range(16):
-                import mido
-                from lb.sequencer import SequencerEvent
-                self.sequencers[0].events.append(
-                    SequencerEvent(message=mido.Message('note_on', note=64+i), position=i/3.7),
-                )
-                self.sequencers[0].events.append(
-                    SequencerEvent(message=mido.Message('note_off', note=64+i), position=i/3.7+.35),
-                )
+                from lb.sequencer import NOTE_OFF, NOTE_ON, SequencerEvent
+                self.sequencers[0].events.append(SequencerEvent(i/3.7, NOTE_ON, 64+i, 64))
+                self.sequencers[0].events.append(SequencerEvent(i/3.7+.35, NOTE_OFF, 64+i, 64))
             self.sequencers[0].refresh()
 
         self.current_scope = 'sequencer'
@@ -435,6 +518,7 @@ class App:
                 GateParamGroup(self),
                 QuantizerParamGroup(self),
                 PatternParamGroup(self),
+                ViewParamGroup(self),
                 MIDIParamGroup(self),
                 TempoParamGroup(self),
             ],
@@ -450,10 +534,10 @@ class App:
 
         self.controls.rotary_param.left.subscribe(lambda _: self.param_next())
         self.controls.rotary_param.right.subscribe(lambda _: self.param_prev())
-        self.controls.rotary_value1.left.subscribe(lambda _: self.value_dec(lambda x: x.param1))
-        self.controls.rotary_value1.right.subscribe(lambda _: self.value_inc(lambda x: x.param1))
-        self.controls.rotary_value2.left.subscribe(lambda _: self.value_dec(lambda x: x.param2))
-        self.controls.rotary_value2.right.subscribe(lambda _: self.value_inc(lambda x: x.param2))
+        self.controls.rotary_value1.left.subscribe(lambda t: self.value_dec(lambda x: x.param1, t))
+        self.controls.rotary_value1.right.subscribe(lambda t: self.value_inc(lambda x: x.param1, t))
+        self.controls.rotary_value2.left.subscribe(lambda t: self.value_dec(lambda x: x.param2, t))
+        self.controls.rotary_value2.right.subscribe(lambda t: self.value_inc(lambda x: x.param2, t))
         self.controls.play_button.press.subscribe(lambda _: self.on_play())
         self.controls.stop_button.press.subscribe(lambda _: self.on_stop())
         self.controls.record_button.press.subscribe(lambda _: self.on_record())
@@ -465,11 +549,32 @@ class App:
         for i in range(len(self.controls.number_buttons)):
             self.controls.number_buttons[i].press.subscribe((lambda i: lambda _: self.on_number(i))(i))
 
-        self.load_state()
-        self.enable_state_saving = True
+        self.journal_recorder = JournalRecorder(self, journal) if journal else None
 
-        self.display = Display(self)
-        self.display.run()
+        with self.boot.phase('state'):
+            self.load_state(lazy=True)
+        self.enable_state_saving = True
+        self.save_requested = threading.Event()
+        if self.saved_state_path:
+            threading.Thread(target=self.run_state_saver, name='state saver', daemon=True).start()
+            atexit.register(self.flush_state)
+        self.boot.start('patterns', self.decode_patterns)
+
+        self.control_server = None
+        if control_socket:
+            self.control_server = ControlServer(self, control_socket)
+            self.control_server.start()
+
+        if ui:
+            with self.boot.phase('display setup'):
+                self.boot.join('mixer')
+                self.display.setup()
+        self.runtime.start(self)
+        metrics.start(self)
+        locks.start_reporting()
+        self.boot.ready()
+        if ui and not headless:
+            self.display.run()
 
     def select_sequencer(self, s):
         if self.selected_sequencer:
@@ -495,7 +600,7 @@ class App:
     def param_prev(self):
         if self.controls.shift_button.pressed:
             self.current_scope = 'note'
-            events = [x for x in self.selected_sequencer.events if x.message.type == 'note_on']
+            events = [x for x in self.selected_sequencer.events if x.is_note_on]
             self.selected_event = list_prev(events, self.selected_event)
         else:
             self.current_param_group[self.current_scope] = list_prev(self.scope_param_groups[self.current_scope], self.current_param_group[self.current_scope])
@@ -503,24 +608,42 @@ class App:
     def param_next(self):
         if self.controls.shift_button.pressed:
             self.current_scope = 'note'
-            events = [x for x in self.selected_sequencer.events if x.message.type == 'note_on']
+            events = [x for x in self.selected_sequencer.events if x.is_note_on]
             self.selected_event = list_next(events, self.selected_event)
         else:
             self.current_param_group[self.current_scope] = list_next(self.scope_param_groups[self.current_scope], self.current_param_group[self.current_scope])
 
-    def value_dec(self, parameter_getter):
+    def value_step(self, parameter_getter, direction, t=None):
         param = parameter_getter(self.current_param_group[self.current_scope])
-        if param:
-            param.set(list_prev(param.options, param.get()))
-            self.sequencer_is_empty[self.selected_sequencer] = False
-            self.save_state()
-
-    def value_inc(self, parameter_getter):
-        param = parameter_getter(self.current_param_group[self.current_scope])
-        if param:
-            param.set(list_next(param.options, param.get()))
-            self.sequencer_is_empty[self.selected_sequencer] = False
-            self.save_state()
+        if not param:
+            return
+        with self.pending_values_lock:
+            last = self.last_value_step.get(param)
+            interval = t - last[0] if t is not None and last and last[1] == direction else None
+            self.last_value_step[param] = (t, direction)
+            steps = rotary_acceleration(interval, len(param.options))
+            first = not self.pending_values
+            self.pending_values[param] = self.pending_values.get(param, 0) + direction * steps
+        if first:
+            # Steps within one frame are applied together; the display drains them sooner if it is running
+            self.reactor.call_later(1 / 30, self.apply_pending_values)
+
+    def value_dec(self, parameter_getter, t=None):
+        self.value_step(parameter_getter, -1, t)
+
+    def value_inc(self, parameter_getter, t=None):
+        self.value_step(parameter_getter, 1, t)
+
+    def apply_pending_values(self):
+        with self.pending_values_lock:
+            pending = self.pending_values
+            self.pending_values = {}
+        if not pending:
+            return
+        for param, steps in pending.items():
+            param.set(list_step(param.options, param.get(), steps))
+        self.sequencer_is_empty[self.selected_sequencer] = False
+        self.save_state()
 
     def on_number(self, i):
         if self.controls.shift_button.pressed:
@@ -594,12 +717,43 @@ class App:
             self.current_scope = 'sequencer'
             self.selected_event = None
 
+    def decode_patterns(self):
+        for s in self.sequencers:
+            if s.pending_events is not None:
+                s.refresh()
+
     def save_state(self):
-        if not self.enable_state_saving:
+        # Serializing and writing the state takes many clock ticks; only ask the saver thread for it
+        if not self.enable_state_saving or not self.saved_state_path:
             return
+        self.save_requested.set()
+
+    def run_state_saver(self, delay=0.1):
+        while True:
+            self.save_requested.wait()
+            # A knob turn or a burst of presses ends up in one write
+            time.sleep(delay)
+            self.save_requested.clear()
+            try:
+                self.write_state()
+            except Exception:
+                # E.g. a full disk; the next change tries again
+                log.error('state', 'Could not save the state:\n{}', traceback.format_exc())
+
+    def flush_state(self):
+        if self.save_requested.is_set():
+            self.save_requested.clear()
+            self.write_state()
+
+    def get_sequencer_state(self, s):
+        with s.lock:
+            return s.save_state()
+
+    @metrics.timed('app.save_state')
+    def write_state(self):
         with self.state_file_lock:
             state = dict(
-                sequencers=[None if self.sequencer_is_empty[s] else s.save_state() for s in self.sequencers],
+                sequencers=[None if self.sequencer_is_empty[s] else self.get_sequencer_state(s) for s in self.sequencers],
                 metronome=self.metronome_param.get(),
                 tempo=self.tempo_param.get(),
             )
@@ -608,9 +762,9 @@ class App:
                 json.dump(state, f)
             os.rename(tmp_path, self.saved_state_path)
 
-    def load_state(self):
+    def load_state(self, lazy=False):
         with self.state_file_lock:
-            if not os.path.exists(self.saved_state_path):
+            if not self.saved_state_path or not os.path.exists(self.saved_state_path):
                 return
 
             with open(self.saved_state_path) as f:
@@ -619,11 +773,15 @@ class App:
                 except Exception as e:
                     logging.error('State load failed: %s', e)
                     return
+            self.restore_state(state, lazy=lazy)
 
+    def restore_state(self, state, lazy=False):
+        with self.state_file_lock:
             for index, s_state in enumerate(state['sequencers']):
                 self.sequencer_is_empty[self.sequencers[index]] = not s_state
                 if s_state:
-                    self.sequencers[index].load_state(s_state)
+                    # Only the selected pattern is needed to start playing, the rest decode in decode_patterns()
+                    self.sequencers[index].load_state(s_state, lazy=lazy and self.sequencers[index] is not self.selected_sequencer)
 
             self.metronome_param.set(state['metronome'])
             self.tempo_param.set(state['tempo'])
@@ -0,0 +1,308 @@
+import itertools
+import time
+import tracemalloc
+import mido
+from . import log
+from .piano_roll import NoteIndex
+from .synthetic import load_session
+from .util import percentile
+
+
+def run_display_benchmark(app, frames=300):
+    display = app.display
+    display.reset_draw_times()
+    frame_times = []
+    for _ in range(frames):
+        t = time.perf_counter()
+        display.render_frame()
+        frame_times.append(time.perf_counter() - t)
+
+    results = {'frame': frame_times}
+    results.update(display.draw_times)
+    display.draw_times = None
+    return results
+
+
+def summarize(results):
+    return {
+        name: {
+            'count': len(times),
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+        }
+        for name, times in results.items()
+    }
+
+
+def print_summary(title, summary):
+    print(title)
+    print('  {:<24} {:>7} {:>9} {:>9} {:>9}'.format('', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, s in summary.items():
+        print('  {:<24} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            name, s['count'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000,
+        ))
+
+
+SESSIONS = {
+    'empty': dict(sequencers=0, recording=False),
+    'light': dict(sequencers=4, notes=32, polyphony=2, recording=False),
+    'dense': dict(sequencers=16, notes=512, polyphony=8, bars=16, recording=False),
+    'recording': dict(sequencers=16, notes=256, polyphony=8, recording=True),
+}
+
+
+def measure_allocation(fx):
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fx()
+    return tracemalloc.get_traced_memory()[1] - base
+
+
+def measure_tick_allocations(sequencers, ticks):
+    tempo = sequencers[0].app.tempo
+    tracemalloc.start()
+    # The measurement itself allocates the integers it returns
+    overhead = min(measure_allocation(lambda: None) for _ in range(10))
+
+    quiet = quiet_allocating = busy = busy_bytes = 0
+    for _ in range(ticks):
+        for s in sequencers:
+            cursor = s.edge_cursor
+            allocated = max(0, measure_allocation(s.on_clock) - overhead)
+            if s.edge_cursor == cursor:
+                quiet += 1
+                quiet_allocating += allocated > 0
+            else:
+                busy += 1
+                busy_bytes += allocated
+        tempo.external_ticks += 1
+    tracemalloc.stop()
+    return {
+        'quiet': quiet,
+        'quiet_allocating': quiet_allocating,
+        'busy': busy,
+        'busy_bytes': busy_bytes / max(1, busy),
+    }
+
+
+def run_tick_benchmark(app, ticks=2000):
+    sequencers = [s for s in app.sequencers if s.running]
+    # Keep note output logging out of the timings
+    with log.muted('midi'):
+        for s in sequencers:
+            s.on_clock()
+        t = time.perf_counter()
+        for _ in range(ticks):
+            for s in sequencers:
+                s.on_clock()
+            app.tempo.external_ticks += 1
+        tick_time = (time.perf_counter() - t) / ticks
+        results = measure_tick_allocations(sequencers, ticks)
+    results['sequencers'] = len(sequencers)
+    results['tick'] = tick_time
+    results['stuck_notes'] = count_stuck_notes(sequencers)
+    return results
+
+
+def count_stuck_notes(sequencers):
+    # Notes the sequencer keeps sounding although no note interval covers them any more
+    return sum(
+        1
+        for s in sequencers
+        for note in range(128)
+        if s.open_events[note] is not None and s.open_counts[note] <= 0
+    )
+
+
+def print_tick_summary(title, summary):
+    print(title)
+    print('  {} sequencers, {:.1f} us per tick'.format(summary['sequencers'], summary['tick'] * 1000000))
+    print('  {} of {} quiet sequencer ticks allocated'.format(summary['quiet_allocating'], summary['quiet']))
+    print('  {:.0f} bytes allocated per sequencer tick with note changes ({} ticks)'.format(summary['busy_bytes'], summary['busy']))
+    print('  {} notes stuck on'.format(summary['stuck_notes']))
+
+
+def run_tick_sessions(app, sessions=None, ticks=2000):
+    summaries = {}
+    for name in sessions or SESSIONS:
+        for s in app.sequencers:
+            s.reset()
+        load_session(app, **SESSIONS[name])
+        if any(s.running for s in app.sequencers):
+            summaries[name] = run_tick_benchmark(app, ticks=ticks)
+    return summaries
+
+
+def run_display_sessions(app, sessions=None, frames=300):
+    summaries = {}
+    for name in sessions or SESSIONS:
+        for s in app.sequencers:
+            s.reset()
+        load_session(app, **SESSIONS[name])
+        summaries[name] = summarize(run_display_benchmark(app, frames=frames))
+    return summaries
+
+
+PATTERNS = {
+    'sparse': dict(notes=64, polyphony=1),
+    'medium': dict(notes=512, polyphony=8),
+    'dense': dict(notes=2048, polyphony=12, bars=16),
+}
+
+
+def time_calls(fx, min_calls=20, min_time=0.05):
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_calls or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        fx()
+        times.append(time.perf_counter() - t)
+    return {'count': len(times), 'p50': percentile(times, 50), 'min': min(times)}
+
+
+def load_pattern(app, pattern, sequencers=1, wrap=True):
+    for s in app.sequencers:
+        s.reset()
+        s.recording = False
+        s.currently_recording_notes = {}
+    app.tempo.external_ticks = 0
+    load_session(app, sequencers=sequencers, recording=False, wrap=wrap, **PATTERNS[pattern])
+    return app.sequencers[0]
+
+
+def make_stepper(sequencer, step=1 / 24):
+    positions = itertools.cycle([i * step for i in range(int(sequencer.get_length() / step))])
+    return lambda: next(positions)
+
+
+def bench_queries(app, pattern):
+    s = load_pattern(app, pattern)
+    step = make_stepper(s)
+
+    def events_between():
+        p = step()
+        return list(s.get_events_between(p, p + 1 / 24))
+
+    return {
+        'get_events_between': time_calls(events_between),
+        'get_open_events_at_position': time_calls(lambda: s.get_open_events_at_position(step())),
+        'piano_roll.index': time_calls(lambda: NoteIndex(s.filtered_events, s.get_length())),
+    }
+
+
+def bench_refresh(app, pattern):
+    s = load_pattern(app, pattern)
+    results = {'refresh.none': time_calls(s.refresh)}
+    for name, fx, undo in [
+        ('quantizer', lambda: setattr(s.quantizer_filter, 'divisor', 16), lambda: setattr(s.quantizer_filter, 'divisor', None)),
+        ('gate_length', lambda: setattr(s.gate_length_filter, 'multiplier', 1.5), lambda: setattr(s.gate_length_filter, 'multiplier', 1)),
+        ('offset', lambda: setattr(s.offset_filter, 'offset', 0.3), lambda: setattr(s.offset_filter, 'offset', 0)),
+    ]:
+        fx()
+        results['refresh.' + name] = time_calls(s.refresh)
+        undo()
+    s.refresh()
+    return results
+
+
+def bench_on_clock(app, pattern, sequencers=16):
+    load_pattern(app, pattern, sequencers=sequencers)
+    running = [s for s in app.sequencers if s.running]
+
+    def tick():
+        for s in running:
+            s.on_clock()
+        app.tempo.external_ticks += 1
+
+    return {f'on_clock.{len(running)}': time_calls(tick, min_calls=200)}
+
+
+def bench_recording(app, pattern):
+    s = load_pattern(app, pattern)
+    s.recording = True
+    messages = itertools.cycle([
+        mido.Message(type, note=note, velocity=100 if type == 'note_on' else 0)
+        for note in range(36, 84)
+        for type in ('note_on', 'note_off')
+    ])
+
+    def record():
+        s.process_message(next(messages))
+        app.tempo.external_ticks += 1
+
+    results = {'process_message.recording': time_calls(record, min_calls=200)}
+    s.recording = False
+    return results
+
+
+def bench_state(app, pattern):
+    s = load_pattern(app, pattern)
+    state = s.save_state()
+    return {
+        'save_state': time_calls(s.save_state),
+        'load_state': time_calls(lambda: s.load_state(state)),
+    }
+
+
+def bench_piano_roll(app, pattern):
+    s = load_pattern(app, pattern)
+    display = app.display
+    surface = display.screen.subsurface((0, 180, display.screen.get_width(), 220))
+    return {'piano_roll.draw': time_calls(lambda: display.draw_sequencer(surface, s))}
+
+
+MICRO_BENCHMARKS = [bench_queries, bench_refresh, bench_on_clock, bench_recording, bench_state, bench_piano_roll]
+
+
+def run_micro_benchmarks(app, patterns=None):
+    results = {}
+    # Keep thru and recorded note logging out of the timings
+    with log.muted('midi'):
+        for pattern in patterns or PATTERNS:
+            for benchmark in MICRO_BENCHMARKS:
+                for name, result in benchmark(app, pattern).items():
+                    results[f'{name}.{pattern}'] = result
+        for s in app.sequencers:
+            s.reset()
+    return results
+
+
+def print_micro_summary(results):
+    print('micro')
+    print('  {:<40} {:>7} {:>9} {:>9}'.format('', 'count', 'p50 us', 'min us'))
+    for name, s in results.items():
+        print('  {:<40} {:>7} {:>9.1f} {:>9.1f}'.format(name, s['count'], s['p50'] * 1000000, s['min'] * 1000000))
+
+
+def flatten_timings(results):
+    timings = {}
+    for name, s in results.get('display', {}).items():
+        if s:
+            timings[f'display.{name}'] = s['frame']['p50']
+    for name, s in results.get('ticks', {}).items():
+        timings[f'ticks.{name}'] = s['tick']
+    # The fastest call is the least noisy figure for a micro benchmark
+    for name, s in results.get('micro', {}).items():
+        timings[f'micro.{name}'] = s['min']
+    return timings
+
+
+def compare_to_baseline(results, baseline, threshold=0.25):
+    current = flatten_timings(results)
+    previous = flatten_timings(baseline)
+    rows = []
+    for name in sorted(current.keys() & previous.keys()):
+        if previous[name]:
+            ratio = current[name] / previous[name]
+            rows.append((name, previous[name], current[name], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_comparison(rows):
+    print('baseline comparison')
+    print('  {:<48} {:>10} {:>10} {:>7}'.format('', 'base us', 'now us', 'ratio'))
+    for name, previous, current, ratio, regressed in rows:
+        print('  {:<48} {:>10.1f} {:>10.1f} {:>6.2f}x{}'.format(
+            name, previous * 1000000, current * 1000000, ratio, '  REGRESSION' if regressed else '',
+        ))
@@ -0,0 +1,56 @@
+import contextlib
+import threading
+import time
+
+
+class BootTimeline:
+    def __init__(self, started=None, report=False):
+        self.started = time.monotonic() if started is None else started
+        self.report_on_ready = report
+        self.phases = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.monotonic() - self.started
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((start, self.now() - start, threading.current_thread().name, name))
+
+    def start(self, name, fx):
+        # Runs an independent boot step in the background; whoever needs its result calls join(name)
+        def run():
+            with self.phase(name):
+                fx()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads[name] = thread
+        thread.start()
+        return thread
+
+    def join(self, name):
+        thread = self.threads.get(name)
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    def ready(self):
+        with self.lock:
+            self.phases.append((self.now(), 0, threading.current_thread().name, 'ready'))
+        if self.report_on_ready:
+            self.report()
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases)
+        print('Boot timeline:')
+        for start, duration, thread, name in phases:
+            print(f'  {start * 1000:7.1f} ms  +{duration * 1000:6.1f} ms  {thread:<12} {name}')
+        for name, thread in self.threads.items():
+            if thread.is_alive():
+                print(f'  {name} still running')
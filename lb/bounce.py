@@ -0,0 +1,198 @@
+import argparse
+import heapq
+import math
+import sys
+from . import log
+from .sequencer import NOTE_OFF, NOTE_ON
+from .smf import SMFWriter, iter_tracks
+
+
+def get_pattern(sequencer):
+    # The notes as build_edges sees them: each note-on is paired with its note-off by get_note_offs, zero-length notes
+    # never sound, and a note without a note-off or wrapping around the loop end is already sounding at the loop start
+    length = sequencer.get_length()
+    held = []
+    edges = []
+    with sequencer.lock:
+        events = sequencer.filtered_events
+        note_offs = sequencer.get_note_offs(events)
+        for event in events:
+            if not event.is_note_on:
+                continue
+            start = event.position % length
+            off = note_offs[id(event)]
+            end = off.position % length if off else start
+            if off and end == start:
+                continue
+            if end < start or not off:
+                held.append((event.note, event.velocity))
+            if off:
+                edges.append((start, 1, event.note, event.velocity))
+                edges.append((end, -1, event.note, 0))
+    edges.sort(key=lambda x: (x[0], x[1]))
+    return held, edges
+
+
+def get_clock_tick(position, base, loop_ticks):
+    # First clock tick of the loop starting at tick `base` at which the engine applies an edge: the position worked
+    # out the way Sequencer.get_position does, float rounding included, is at or past the edge. Edges after the last
+    # tick of the loop are applied on the wrap.
+    length = loop_ticks / 24
+    tick = math.ceil(position * 24)
+    while tick > 0 and ((base + tick - 1) / 24) % length >= position:
+        tick -= 1
+    while tick < loop_ticks and ((base + tick) / 24) % length < position:
+        tick += 1
+    return base + tick
+
+
+def iter_edges(edges, length, beats):
+    # The engine moves on 24 clock ticks per beat
+    loop_ticks = round(length * 24)
+    end_tick = beats * 24
+    for base in range(0, end_tick, loop_ticks):
+        for position, delta, note, velocity in edges:
+            tick = get_clock_tick(position, base, loop_ticks)
+            if tick >= end_tick:
+                return
+            yield tick, delta, note, velocity
+
+
+def iter_sequencer_events(sequencer, beats, ppq):
+    # Mirrors Sequencer.on_clock: a note sounds while any of its intervals covers the playhead, so overlapping notes of
+    # the same pitch are not retriggered, and changes within one clock tick are applied together before anything is sent
+    channel = sequencer.output_channel - 1
+    held, edges = get_pattern(sequencer)
+    counts = [0] * 128
+    velocities = [0] * 128
+    notes_on = bytearray(128)
+    for note, velocity in held:
+        counts[note] += 1
+        velocities[note] = velocity
+
+    def reconcile(clock_tick, notes):
+        tick = round(clock_tick * ppq / 24)
+        notes = sorted(notes)
+        for note in notes:
+            if notes_on[note] and counts[note] <= 0:
+                notes_on[note] = 0
+                yield tick, 0, channel, note, 0
+        for note in notes:
+            if not notes_on[note] and counts[note] > 0:
+                notes_on[note] = 1
+                yield tick, 1, channel, note, velocities[note]
+
+    changed = {note for note, _ in held}
+    last_tick = 0
+    for tick, delta, note, velocity in iter_edges(edges, sequencer.get_length(), beats):
+        if tick != last_tick:
+            yield from reconcile(last_tick, changed)
+            changed = set()
+            last_tick = tick
+        counts[note] += delta
+        if delta > 0:
+            velocities[note] = velocity
+        changed.add(note)
+    yield from reconcile(last_tick, changed)
+
+    # Notes still sounding are closed at the end, like stopping the sequencer does
+    end_tick = beats * ppq
+    for note in range(128):
+        if notes_on[note]:
+            yield end_tick, 0, channel, note, 0
+
+
+def bounce(sequencers, path, bars, bpm, bar_size=4, ppq=480):
+    beats = bars * bar_size
+    writer = SMFWriter(path, ppq=ppq)
+    writer.write_tempo(0, bpm)
+
+    count = 0
+    # Every sequencer sends its own notes, as it does live; within a tick note-offs come first
+    streams = [iter_sequencer_events(s, beats, ppq) for s in sequencers]
+    for tick, is_on, channel, note, velocity in heapq.merge(*streams):
+        if is_on:
+            writer.write_message(tick, (NOTE_ON | channel, note, velocity))
+        else:
+            writer.write_message(tick, (NOTE_OFF | channel, note, 0))
+        count += 1
+
+    writer.close(beats * ppq)
+    return count
+
+
+def play_live(app, sequencers, bars):
+    # Clocks the same sequencers through the engine tick by tick, like the tick benchmark, and collects what they send
+    tempo = app.tempo
+    sent = []
+    for s in sequencers:
+        s.output.subscribe(lambda data: sent.append((tempo.external_ticks, data)))
+    tempo.external_ticks = 0
+    for s in sequencers:
+        s.start()
+    with log.muted('midi'):
+        for _ in range(bars * tempo.bar_size * 24):
+            for s in sequencers:
+                s.on_clock()
+            tempo.external_ticks += 1
+        for s in sequencers:
+            s.stop()
+    return sent
+
+
+def get_notes_by_key(messages):
+    notes = {}
+    for position, status, note, velocity in messages:
+        is_on = status & 0xF0 == NOTE_ON and velocity > 0
+        notes.setdefault((status & 0x0F, note), []).append((position, is_on, velocity if is_on else 0))
+    return notes
+
+
+def get_mismatches(path, sent):
+    # Compares a bounced file with what the engine sent, note by note, with the file's times converted to clock ticks
+    bounced = get_notes_by_key(
+        (tick * 24 / ppq, status, note, velocity)
+        for _, ppq, messages in iter_tracks(path)
+        for tick, status, note, velocity in messages
+        if status & 0xF0 in (NOTE_OFF, NOTE_ON)
+    )
+    played = get_notes_by_key((tick, *data) for tick, data in sent)
+    mismatches = []
+    for key in sorted(bounced.keys() | played.keys()):
+        a, b = bounced.get(key, []), played.get(key, [])
+        if len(a) != len(b) or any(x[1:] != y[1:] or abs(x[0] - y[0]) > 0.5 for x, y in zip(a, b)):
+            mismatches.append(key)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render sequencers from a saved state to a Standard MIDI File')
+    parser.add_argument('output')
+    parser.add_argument('--state', default='state.json')
+    parser.add_argument('--bars', type=int, default=16)
+    parser.add_argument('--sequencer', type=int, action='append', help='1-based sequencer number, may be repeated (default: all non-empty)')
+    parser.add_argument('--bpm', type=float, help='tempo (default: the saved tempo)')
+    parser.add_argument('--ppq', type=int, default=480)
+    parser.add_argument('--check', action='store_true', help='also play the sequencers through the engine and fail if it sends different notes')
+    args = parser.parse_args()
+
+    from .simulation import create_app
+
+    app = create_app(state_path=args.state)
+    app.enable_state_saving = False
+    if args.sequencer:
+        sequencers = [app.sequencers[i - 1] for i in args.sequencer]
+    else:
+        sequencers = [s for s in app.sequencers if not app.sequencer_is_empty[s]]
+
+    bpm = args.bpm or app.input_manager.internal_clock.bpm
+    count = bounce(sequencers, args.output, args.bars, bpm, bar_size=app.tempo.bar_size, ppq=args.ppq)
+    print(f'Wrote {count} events from {len(sequencers)} sequencers to {args.output}')
+    if args.check:
+        mismatches = get_mismatches(args.output, play_live(app, sequencers, args.bars))
+        if mismatches:
+            sys.exit(f'{len(mismatches)} notes differ from the live engine, first on channel {mismatches[0][0] + 1} note {mismatches[0][1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import json
+import os
+import selectors
+import socket
+import stat
+import threading
+import time
+import traceback
+from . import log
+
+
+class ControlClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = b''
+        self.outbox = b''
+        self.subscribed = False
+        self.needs_full = True
+
+
+class ControlServer(threading.Thread):
+    # Newline-delimited JSON over a UNIX socket. Requests look like {"id": 1, "cmd": "play"}, every request gets
+    # {"id": 1, "ok": true} or {"id": 1, "error": "..."} back. After {"cmd": "subscribe"} the client receives
+    # {"v": version, "full": {...}} once and then {"v": version, "diff": {...}} with only the changed keys,
+    # at most rate times a second.
+    def __init__(self, app, path, rate=20, max_backlog=256 * 1024):
+        super().__init__(daemon=True)
+        self.app = app
+        self.path = path
+        self.interval = 1 / rate
+        self.max_backlog = max_backlog
+        self.version = 0
+        self.state = {}
+        self.clients = {}
+        self.selector = selectors.DefaultSelector()
+        self.commands = {
+            'play': lambda _: app.on_play(),
+            'stop': lambda _: app.on_stop(),
+            'record': lambda _: app.on_record(),
+            'clear': lambda _: app.on_clear(),
+            'scope': lambda _: app.on_scope(),
+            'shift': lambda r: app.controls.shift_button.set_pressed(bool(r.get('pressed', True))),
+            'select': lambda r: app.select_sequencer(app.sequencers[int(r['sequencer'])]),
+            'set': self.on_set,
+            'ok': self.on_ok,
+            'dump_stalls': lambda r: app.runtime.dump_stalls(r.get('path')),
+            'subscribe': None,
+            'unsubscribe': None,
+        }
+
+        if os.path.exists(path):
+            # A stale socket from an earlier run; anything else at that path is not ours to delete
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise FileExistsError(f'{path} exists and is not a socket')
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+    def find_param(self, request):
+        for groups in self.app.scope_param_groups.values():
+            for group in groups:
+                if group.name == request['group']:
+                    param = group.param2 if int(request.get('param', 1)) == 2 else group.param1
+                    if param:
+                        return param
+        raise ValueError(f'No param {request.get("param", 1)} in group {request["group"]!r}')
+
+    def on_set(self, request):
+        param = self.find_param(request)
+        value = request['value']
+        if value not in param.options:
+            raise ValueError(f'{value!r} is not a valid {param.name} value')
+        param.set(value)
+        self.app.sequencer_is_empty[self.app.selected_sequencer] = False
+        self.app.save_state()
+
+    def on_ok(self, request):
+        param = self.find_param(request)
+        param.ok()
+        self.app.save_state()
+
+    def get_state(self):
+        app = self.app
+        state = {
+            'position': round(app.tempo.get_position(), 3),
+            'bpm': round(app.tempo.bpm, 2),
+            'selected': app.sequencers.index(app.selected_sequencer),
+            'bank': app.selected_sequencer_bank,
+            'scope': app.current_scope,
+            'group': app.current_param_group[app.current_scope].name,
+            'external_clock': bool(app.input_manager.active_clock),
+        }
+        for i, s in enumerate(app.sequencers):
+            state[f'sequencers.{i}'] = [s.running, s.recording, s.start_scheduled, s.stop_scheduled, s.output_channel, app.sequencer_is_empty[s]]
+        for groups in app.scope_param_groups.values():
+            for group in groups:
+                for slot, param in ((1, group.param1), (2, group.param2)):
+                    if param:
+                        state[f'params.{group.name}.{slot}'] = param.get()
+        return state
+
+    def run(self):
+        next_publish = time.monotonic()
+        while True:
+            for key, events in self.selector.select(max(0, next_publish - time.monotonic())):
+                if key.fileobj is self.server:
+                    self.accept()
+                    continue
+                client = key.data
+                if events & selectors.EVENT_READ:
+                    self.receive(client)
+                if events & selectors.EVENT_WRITE and client.sock in self.clients:
+                    self.flush(client)
+            if time.monotonic() >= next_publish:
+                next_publish = time.monotonic() + self.interval
+                self.publish()
+
+    def accept(self):
+        sock, _ = self.server.accept()
+        sock.setblocking(False)
+        client = ControlClient(sock)
+        self.clients[sock] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def drop(self, client):
+        self.selector.unregister(client.sock)
+        del self.clients[client.sock]
+        client.sock.close()
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+        client.inbox += data
+        *lines, client.inbox = client.inbox.split(b'\n')
+        for line in lines:
+            if line.strip() and client.sock in self.clients:
+                self.send(client, self.handle(client, line))
+
+    def handle(self, client, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Requests must be JSON objects')
+        except ValueError as e:
+            return {'id': None, 'error': str(e)}
+        try:
+            cmd = request['cmd']
+            if cmd not in self.commands:
+                raise ValueError(f'Unknown command {cmd!r}')
+            if cmd == 'subscribe':
+                client.subscribed = True
+                client.needs_full = True
+            elif cmd == 'unsubscribe':
+                client.subscribed = False
+            else:
+                self.app.reactor.call(self.commands[cmd], request)
+            return {'id': request.get('id'), 'ok': True}
+        except Exception as e:
+            return {'id': request.get('id'), 'error': str(e)}
+
+    def send(self, client, message):
+        client.outbox += json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        self.flush(client)
+
+    def flush(self, client):
+        if client.sock not in self.clients:
+            return
+        try:
+            sent = client.sock.send(client.outbox)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.drop(client)
+            return
+        client.outbox = client.outbox[sent:]
+        self.selector.modify(client.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbox else 0), client)
+
+    def publish(self):
+        subscribers = [c for c in self.clients.values() if c.subscribed]
+        if not subscribers:
+            self.state = {}
+            return
+        try:
+            # Read on the reactor, like commands, so the engine doesn't change under the snapshot
+            state = self.app.reactor.call(self.get_state)
+        except Exception:
+            log.error('control', 'Could not build the control socket state:\n{}', traceback.format_exc())
+            return
+        diff = {k: v for k, v in state.items() if self.state.get(k) != v}
+        if diff:
+            self.version += 1
+            self.state = state
+        for client in subscribers:
+            if len(client.outbox) > self.max_backlog:
+                # A client that can't keep up skips diffs and gets a fresh full state once it has drained
+                client.needs_full = True
+                continue
+            if client.needs_full:
+                client.needs_full = False
+                self.send(client, {'v': self.version, 'full': state})
+            elif diff:
+                self.send(client, {'v': self.version, 'diff': diff})
@@ -1,38 +1,60 @@
-import pygame
 import threading
 import time
 from rx.subject import Subject
+from .gpio import MCP23017GPIO, wiringpi
 
-try:
-    import wiringpi
-except ImportError:
-    wiringpi = None
+
+# Quadrature transition table indexed by (previous_state << 2) | state, state being (clk << 1) | dt
+QUADRATURE_STEPS = [0, -1, 1, 0, 1, 0, 0, -1, -1, 0, 0, 1, 0, 1, -1, 0]
 
 
 class Button:
-    def __init__(self, controls, pin=None, key=None):
+    def __init__(self, pin=None, key=None, debounce=0.01):
         self.pin = pin
         self.key = key
+        self.debounce = debounce
         self.press = Subject()
+        self.release = Subject()
         self.pressed = False
-        if wiringpi:
-            wiringpi.pinMode(pin, 0)
-            wiringpi.pullUpDnControl(pin, 2)
-            self.pressed = 1 - wiringpi.digitalRead(self.pin)
-
-    def update(self):
-        if wiringpi:
-            v = 1 - wiringpi.digitalRead(self.pin)
-            if v and not self.pressed:
-                self.press.on_next(None)
-            self.pressed = v
+        self.candidate = None
+        self.candidate_since = None
+
+    def setup(self, gpio):
+        gpio.setup_input(self.pin)
+
+    def reset(self, levels):
+        self.pressed = 1 - levels[self.pin]
+        self.candidate = None
+
+    def is_settling(self):
+        return self.candidate is not None
+
+    def update(self, levels, now):
+        v = 1 - levels[self.pin]
+        if v == self.pressed:
+            self.candidate = None
+            return
+        if v != self.candidate:
+            self.candidate = v
+            self.candidate_since = now
+        if now - self.candidate_since >= self.debounce:
+            self.candidate = None
+            self.set_pressed(v)
+
+    def set_pressed(self, v):
+        was_pressed = self.pressed
+        self.pressed = v
+        if v and not was_pressed:
+            self.press.on_next(None)
+        if not v and was_pressed:
+            self.release.on_next(None)
 
     def process_event(self, event):
-        if event.type == pygame.KEYDOWN and event.key == self.key:
-            self.pressed = True
-            self.press.on_next(None)
-        if event.type == pygame.KEYUP and event.key == self.key:
-            self.pressed = False
+        import pygame
+        if event.type == pygame.KEYDOWN and event.key == getattr(pygame, self.key):
+            self.set_pressed(True)
+        if event.type == pygame.KEYUP and event.key == getattr(pygame, self.key):
+            self.set_pressed(False)
 
 
 class Rotary:
@@ -43,65 +65,74 @@ class Rotary:
         self.key_right = key_right
         self.left = Subject()
         self.right = Subject()
-        self.pending = None
-
-        if wiringpi:
-            wiringpi.pinMode(pin_clk, 0)
-            wiringpi.pullUpDnControl(pin_clk, 2)
-            wiringpi.pinMode(pin_dt, 0)
-            wiringpi.pullUpDnControl(pin_dt, 2)
-            self.clk_last = 1 - wiringpi.digitalRead(self.pin_clk)
-
-    def update(self):
-        if wiringpi:
-            clk = 1 - wiringpi.digitalRead(self.pin_clk)
-            dt = 1 - wiringpi.digitalRead(self.pin_dt)
-            if clk and not dt:
-                self.pending = 'left'
-            if not clk and dt:
-                self.pending = 'right'
-            if clk and dt:
-                if self.pending == 'left':
-                    self.left.on_next(None)
-                if self.pending == 'right':
-                    self.right.on_next(None)
-                self.pending = None
-            self.clk_last = clk
+        self.state = 0
+        self.steps = 0
+
+    def setup(self, gpio):
+        gpio.setup_input(self.pin_clk)
+        gpio.setup_input(self.pin_dt)
+
+    def reset(self, levels):
+        self.state = ((1 - levels[self.pin_clk]) << 1) | (1 - levels[self.pin_dt])
+        self.steps = 0
+
+    def is_settling(self):
+        return False
+
+    def update(self, levels, now):
+        clk = 1 - levels[self.pin_clk]
+        dt = 1 - levels[self.pin_dt]
+        state = (clk << 1) | dt
+        if state == self.state:
+            return
+        self.steps += QUADRATURE_STEPS[(self.state << 2) | state]
+        self.state = state
+        if state == 0:
+            self.steps = 0
+        if state == 3:
+            # Contact bounce cancels itself out in the step count, so only emit on a full half-cycle
+            if self.steps >= 2:
+                self.left.on_next(now)
+            if self.steps <= -2:
+                self.right.on_next(now)
+            self.steps = 0
 
     def process_event(self, event):
-        if event.type == pygame.KEYDOWN and event.key == self.key_left:
-            self.left.on_next(None)
-        if event.type == pygame.KEYDOWN and event.key == self.key_right:
-            self.right.on_next(None)
+        import pygame
+        if event.type == pygame.KEYDOWN and event.key == getattr(pygame, self.key_left):
+            self.left.on_next(time.monotonic())
+        if event.type == pygame.KEYDOWN and event.key == getattr(pygame, self.key_right):
+            self.right.on_next(time.monotonic())
 
 
 class Controls(threading.Thread):
-    def __init__(self, app):
+    def __init__(self, app, gpio=None):
         super().__init__(daemon=True)
         self.app = app
 
-        if wiringpi:
-            pin_base = 100
-            i2c_addr = 0x20
-            wiringpi.wiringPiSetup()
-            wiringpi.mcp23017Setup(pin_base, i2c_addr)
-
-        self.shift_button = Button(110, key=pygame.K_LSHIFT)
-        self.play_button = Button(21, key=pygame.K_SPACE)
-        self.stop_button = Button(20, key=pygame.K_ESCAPE)
-        self.record_button = Button(16, key=pygame.K_r)
-        self.clear_button = Button(19, key=pygame.K_c)
-        self.scope_button = Button(111, key=pygame.K_BACKSPACE)
+        # gpio=False means no hardware at all, e.g. when the controls live in another process
+        if gpio is None and wiringpi:
+            gpio = MCP23017GPIO(pin_base=100, i2c_addr=0x20)
+        self.gpio = gpio or None
+
+        # Keyboard bindings are pygame key names, resolved only when the display feeds in key events
+
+        self.shift_button = Button(110, key='K_LSHIFT')
+        self.play_button = Button(21, key='K_SPACE')
+        self.stop_button = Button(20, key='K_ESCAPE')
+        self.record_button = Button(16, key='K_r')
+        self.clear_button = Button(19, key='K_c')
+        self.scope_button = Button(111, key='K_BACKSPACE')
         self.number_buttons = [
-            Button(pin, key=pygame.K_1 + index)
+            Button(pin, key=f'K_{index + 1}')
             for index, pin
             in enumerate([17, 27, 27, 27])
         ]
-        self.rotary_param = Rotary(13, 26, key_left=pygame.K_DOWN, key_right=pygame.K_UP)
-        self.rotary_value1 = Rotary(108, 109, key_left=pygame.K_q, key_right=pygame.K_w)
-        self.ok_button1 = Button(2, key=pygame.K_e)
-        self.rotary_value2 = Rotary(112, 114, key_left=pygame.K_a, key_right=pygame.K_s)
-        self.ok_button2 = Button(2, key=pygame.K_d)
+        self.rotary_param = Rotary(13, 26, key_left='K_DOWN', key_right='K_UP')
+        self.rotary_value1 = Rotary(108, 109, key_left='K_q', key_right='K_w')
+        self.ok_button1 = Button(2, key='K_e')
+        self.rotary_value2 = Rotary(112, 114, key_left='K_a', key_right='K_s')
+        self.ok_button2 = Button(2, key='K_d')
 
         self.items = [
             self.shift_button,
@@ -117,12 +148,57 @@ class Controls(threading.Thread):
             self.ok_button2,
         ] + self.number_buttons
 
+        if self.gpio:
+            for i in self.items:
+                i.setup(self.gpio)
+            levels = self.gpio.read()
+            for i in self.items:
+                i.reset(levels)
+
     def run(self):
+        if not self.gpio:
+            return
+        self.app.runtime.setup_thread('controls')
         while True:
-            time.sleep(1 / 1000)
-            for i in self.items:
-                i.update()
+            # Wake up early enough to confirm a debounced button change even if no further edge arrives
+            settling = any(i.is_settling() for i in self.items)
+            self.gpio.wait(0.005 if settling else 1)
+            self.post(self.update, self.gpio.read(), time.monotonic())
+
+    def post(self, fx, *args):
+        # Control changes are handled on the engine's reactor; the split UI process has none and handles them here
+        if self.app.reactor:
+            self.app.reactor.post(fx, *args)
+        else:
+            fx(*args)
+
+    def update(self, levels, now):
+        for i in self.items:
+            i.update(levels, now)
 
     def process_event(self, event):
+        # Keyboard events arrive on the display thread
+        self.post(self.dispatch_event, event)
+
+    def dispatch_event(self, event):
         for i in self.items:
             i.process_event(event)
+
+    def subscribe_events(self, fx):
+        # fx(index, value, t) with value 1/0 for a button press/release and -1/1 for a rotary step
+        for index, item in enumerate(self.items):
+            if isinstance(item, Button):
+                item.press.subscribe((lambda i: lambda _: fx(i, 1, time.monotonic()))(index))
+                item.release.subscribe((lambda i: lambda _: fx(i, 0, time.monotonic()))(index))
+            else:
+                item.left.subscribe((lambda i: lambda t: fx(i, -1, t))(index))
+                item.right.subscribe((lambda i: lambda t: fx(i, 1, t))(index))
+
+    def apply_event(self, index, value, t):
+        item = self.items[index]
+        if isinstance(item, Button):
+            item.set_pressed(bool(value))
+        elif value > 0:
+            item.right.on_next(t)
+        else:
+            item.left.on_next(t)
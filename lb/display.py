@@ -6,6 +6,10 @@ import pygame.gfxdraw
 import time
 import threading
 import sys
+from collections import defaultdict
+from lb import metrics
+from lb.frame_scheduler import FrameScheduler
+from lb.piano_roll import NoteIndex, get_view_window
 from lb.util import number_to_note
 
 os.environ['SDL_VIDEO_CENTERED'] = '1'
@@ -28,9 +32,17 @@ def draw_text_centered(surface, font, text, color, rect):
 
 
 class Display(threading.Thread):
-    def __init__(self, app):
+    def __init__(self, app, fps=30, idle_fps=5, headless=False, size=(800, 400), output=None):
         super().__init__(daemon=True)
         self.app = app
+        self.headless = headless or output is not None
+        self.output = output
+        self.size = size
+        self.draw_times = None
+        self.note_indexes = {}
+        self.assets_lock = threading.Lock()
+        self.assets_loaded = False
+        self.frame_scheduler = FrameScheduler(fps=fps, idle_fps=idle_fps)
 
         self.had_midi_in_activity = False
         self.had_midi_out_activity = False
@@ -39,13 +51,25 @@ class Display(threading.Thread):
         self.app.input_manager.message.subscribe(lambda stuff: self._on_midi_in(stuff[1]))
         self.app.output_manager.message.subscribe(lambda _: self._on_midi_out())
 
+        for item in self.app.controls.items:
+            for subject in [getattr(item, x) for x in ['press', 'left', 'right'] if hasattr(item, x)]:
+                subject.subscribe(lambda _: self.frame_scheduler.wake())
+
     def _on_midi_in(self, message):
         self.had_midi_in_activity = True
         if hasattr(message, 'channel'):
             self.midi_in_channel_activity[message.channel] = True
+        self.frame_scheduler.wake()
 
     def _on_midi_out(self):
         self.had_midi_out_activity = True
+        self.frame_scheduler.wake()
+
+    def is_busy(self):
+        for s in self.app.sequencers:
+            if s.running or s.recording or s.start_scheduled or s.stop_scheduled:
+                return True
+        return False
 
     def get_blink(self, type):
         if type == 'beat':
@@ -369,7 +393,8 @@ class Display(threading.Thread):
         w, h = surface.get_size()
 
         toolbar_size = 64
-        self.draw_sequencer_body(
+        self._draw(
+            self.draw_sequencer_body,
             surface.subsurface((toolbar_size, 0, w - toolbar_size, h)),
             sequencer
         )
@@ -401,11 +426,24 @@ class Display(threading.Thread):
                 surface, (a, 0, 0), (0, 0, w, h), 4
             )
 
+    def get_note_index(self, sequencer):
+        cached = self.note_indexes.get(sequencer)
+        if not cached or cached.events is not sequencer.filtered_events or cached.length != sequencer.get_length():
+            cached = NoteIndex(sequencer.filtered_events, sequencer.get_length())
+            self.note_indexes[sequencer] = cached
+        return cached
+
     def draw_sequencer_body(self, surface, sequencer):
+        view_start, view_end = get_view_window(sequencer, sequencer.get_position())
+        view_length = view_end - view_start
+
         def pos_to_x(p):
-            return surface.get_width() * p / sequencer.get_length()
+            return surface.get_width() * (p - view_start) / view_length
+
+        def len_to_w(p):
+            return surface.get_width() * p / view_length
 
-        for i in range(0, sequencer.bars * self.app.tempo.bar_size):
+        for i in range(int(view_start), math.ceil(view_end)):
             color = (50, 50, 100) if (i % 4 == 0) else (30, 30, 30)
             surface.fill(color, rect=(
                 pos_to_x(i),
@@ -417,19 +455,20 @@ class Display(threading.Thread):
         if sequencer.quantizer_filter.divisor:
             q_pos = 4 / sequencer.quantizer_filter.divisor
             q_color = (255, 128, 0)
-            for i in range(0, int(sequencer.get_length() / q_pos)):
+            for i in range(math.ceil(view_start / q_pos), int(view_end / q_pos)):
                 surface.fill(q_color, (pos_to_x(q_pos * i), 0, 2, 5))
 
         with sequencer.lock:
-            dif_notes = [x.message.note for x in sequencer.filtered_events]
-            dif_notes += [x.message.note for x in sequencer.currently_recording_notes.values()]
-            dif_notes = sorted(set(dif_notes))
+            index = self.get_note_index(sequencer)
+            dif_notes = set(index.notes)
+            dif_notes.update(x.note for x in sequencer.currently_recording_notes.values())
+            dif_notes = sorted(dif_notes)
             if len(dif_notes):
                 note_h = surface.get_height() / max(10, len(dif_notes))
                 notes_y = {note: surface.get_height() - (idx + 1) * surface.get_height() / len(dif_notes) for idx, note in enumerate(dif_notes)}
 
                 def draw_note(event, x, w):
-                    c = event.message.velocity / 128
+                    c = event.velocity / 128
                     color = (50 + c * 180, 50, 220 - c * 180)
                     text_color = (
                         min(int(color[0] * 1.5), 255),
@@ -437,9 +476,9 @@ class Display(threading.Thread):
                         min(int(color[2] * 1.5), 255),
                     )
 
-                    note_rect = (x, notes_y[event.message.note], w, note_h)
+                    note_rect = (x, notes_y[event.note], w, note_h)
 
-                    if getattr(event, 'source_event', event) == self.app.selected_event:
+                    if (event.source_event or event) is self.app.selected_event:
                         pygame.draw.rect(
                             surface,
                             (self.get_blink('fast'), self.get_blink('fast') // 2, 0),
@@ -451,6 +490,10 @@ class Display(threading.Thread):
                             ),
                         )
 
+                    if w < 2:
+                        surface.fill(color, (x, note_rect[1], 1, note_h))
+                        return
+
                     pygame.draw.rect(
                         surface,
                         color,
@@ -462,7 +505,7 @@ class Display(threading.Thread):
                         pygame.Rect(note_rect).inflate(-2, -2),
                     )
 
-                    name, o = number_to_note(event.message.note)
+                    name, o = number_to_note(event.note)
                     text = f'{name} {o}'
                     if x >= 0:
                         text_w, text_h = self.font_xs.size(text)
@@ -473,50 +516,36 @@ class Display(threading.Thread):
                                     True,
                                     text_color,
                                 ),
-                                (x + 5, notes_y[event.message.note] + 5, w, note_h),
+                                (x + 5, notes_y[event.note] + 5, w, note_h),
                             )
 
-                m = {}
-                notes = []
-                remaining_events = sequencer.filtered_events[:]
-                for event in remaining_events[:]:
-                    if event.message.type == 'note_on':
-                        m[event.message.note] = event
-                        remaining_events.remove(event)
-                    if event.message.type == 'note_off':
-                        if event.message.note in m:
-                            notes.append((m[event.message.note], event.position - m[event.message.note].position))
-                            remaining_events.remove(event)
-                            del m[event.message.note]
-                for event in remaining_events:
-                    if event.message.type == 'note_off':
-                        if event.message.note in m:
-                            notes.append((m[event.message.note], event.position + sequencer.get_length() - m[event.message.note].position))
-                            del m[event.message.note]
+                segments = list(index.get_segments_between(view_start, view_end))
 
                 for event in sequencer.currently_recording_notes.values():
                     length = sequencer.get_position() - event.position
                     length = sequencer.normalize_position(length)
-                    notes.append((event, length))
-
-                for (event, length) in notes:
-                    draw_note(
-                        event,
-                        pos_to_x(event.position),
-                        pos_to_x(length),
-                    )
+                    segments.append((event.position, length, event))
                     if event.position + length > sequencer.get_length():
-                        draw_note(
-                            event,
-                            pos_to_x(event.position - sequencer.get_length()),
-                            pos_to_x(length),
-                        )
+                        segments.append((event.position - sequencer.get_length(), length, event))
+
+                # Notes narrower than a pixel collapse into a single mark per pixel column and row
+                last_columns = {}
+                for (position, length, event) in segments:
+                    x = pos_to_x(position)
+                    w = len_to_w(length)
+                    if w < 1:
+                        column = int(x)
+                        if last_columns.get(event.note) == column:
+                            continue
+                        last_columns[event.note] = column
+                    draw_note(event, x, w)
 
         # Time indicator
-        surface.fill(
-            (255, 255, 255),
-            (pos_to_x(sequencer.get_position()), 0, 1, surface.get_height())
-        )
+        if view_start <= sequencer.get_position() <= view_end:
+            surface.fill(
+                (255, 255, 255),
+                (pos_to_x(sequencer.get_position()), 0, 1, surface.get_height())
+            )
 
     def draw_sequencer_bank(self, surface, bank_index):
         w, h = surface.get_size()
@@ -573,10 +602,27 @@ class Display(threading.Thread):
                 bank_index
             )
 
-    def run(self):
+    def setup(self):
+        if self.headless:
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
         pygame.init()
-        pygame.mouse.set_visible(0)
-        self.screen = pygame.display.set_mode((800, 400))
+        if self.headless:
+            self.screen = pygame.Surface(self.size)
+        else:
+            pygame.mouse.set_visible(0)
+            self.screen = pygame.display.set_mode(self.size)
+        self.load_assets()
+
+    def load_assets(self):
+        # Safe to start in the background before setup(), which then waits for it to finish
+        with self.assets_lock:
+            if self.assets_loaded:
+                return
+            self._load_assets()
+            self.assets_loaded = True
+
+    def _load_assets(self):
+        pygame.font.init()
         self.font_xs = pygame.font.Font('bryant.ttf', 10)
         self.font_sm = pygame.font.Font('bryant.ttf', 14)
         self.font = pygame.font.Font('bryant.ttf', 24)
@@ -595,81 +641,132 @@ class Display(threading.Thread):
         self.img_play_sm_stopping = self.img_play_sm.copy()
         self.img_play_sm_stopping.fill((255, 0, 64), special_flags=pygame.BLEND_MULT)
 
+    def reset_draw_times(self):
+        self.draw_times = defaultdict(list)
+
+    def _draw(self, fx, *args):
+        if self.draw_times is None and not metrics.ENABLED:
+            return fx(*args)
+        t = time.perf_counter()
+        fx(*args)
+        dt = time.perf_counter() - t
+        if self.draw_times is not None:
+            self.draw_times[fx.__name__].append(dt)
+        if metrics.ENABLED:
+            metrics.record('display.' + fx.__name__, dt)
+
+    def render_frame(self):
         status_bar_h = 40
         v_spacer = 10
         top_bar_h = 120
         seq_h = 220
 
-        while True:
-            self.screen.fill((0, 0, 20))
+        self.screen.fill((0, 0, 20))
+
+        self._draw(
+            self.draw_status_bar,
+            self.screen.subsurface((0, 0, self.screen.get_width(), status_bar_h)),
+        )
+
+        # self.draw_bottom_bar(
+        #     self.screen.subsurface((0, self.screen.get_height() - 40, self.screen.get_width(), 40)),
+        # )
+
+        self._draw(
+            self.draw_sequencer,
+            self.screen.subsurface((
+                0, status_bar_h + v_spacer * 2 + top_bar_h,
+                self.screen.get_width(),
+                seq_h,
+            )),
+            self.app.selected_sequencer,
+        )
 
-            self.draw_status_bar(
-                self.screen.subsurface((0, 0, self.screen.get_width(), status_bar_h)),
+        for i in range(self.app.sequencer_bank_size):
+            s_index = self.app.sequencer_bank_size * self.app.selected_sequencer_bank + i
+            s = self.app.sequencers[s_index]
+            self._draw(
+                self.draw_sequencer_icon,
+                self.screen.subsurface((10 + 70 * i, status_bar_h + v_spacer, 60, top_bar_h)),
+                s
             )
 
-            # self.draw_bottom_bar(
-            #     self.screen.subsurface((0, self.screen.get_height() - 40, self.screen.get_width(), 40)),
-            # )
+        self._draw(
+            self.draw_param_selector,
+            self.screen.subsurface((
+                self.screen.get_width() - 10 - 430,
+                status_bar_h + v_spacer, 170, top_bar_h
+            ))
+        )
 
-            self.draw_sequencer(
+        param_group = self.app.current_param_group[self.app.current_scope]
+
+        if param_group.param1:
+            self._draw(
+                self.draw_param_value,
                 self.screen.subsurface((
-                    0, status_bar_h + v_spacer * 2 + top_bar_h,
-                    self.screen.get_width(),
-                    seq_h,
-                )),
-                self.app.selected_sequencer,
+                    self.screen.get_width() - 10 - 250,
+                    status_bar_h + v_spacer, 120, top_bar_h)
+                ),
+                param_group.param1,
+                (255, 128, 64),
             )
 
-            for i in range(self.app.sequencer_bank_size):
-                s_index = self.app.sequencer_bank_size * self.app.selected_sequencer_bank + i
-                s = self.app.sequencers[s_index]
-                self.draw_sequencer_icon(
-                    self.screen.subsurface((10 + 70 * i, status_bar_h + v_spacer, 60, top_bar_h)),
-                    s
-                )
-
-            self.draw_param_selector(
+        if param_group.param2:
+            self._draw(
+                self.draw_param_value,
                 self.screen.subsurface((
-                    self.screen.get_width() - 10 - 430,
-                    status_bar_h + v_spacer, 170, top_bar_h
-                ))
+                    self.screen.get_width() - 10 - 120,
+                    status_bar_h + v_spacer, 120, top_bar_h)
+                ),
+                param_group.param2,
+                (255, 64, 128),
             )
 
-            param_group = self.app.current_param_group[self.app.current_scope]
+        if self.app.controls.shift_button.pressed:
+            self._draw(
+                self.draw_sequencer_banks,
+                self.screen.subsurface((0, status_bar_h + v_spacer, 70 * 4, top_bar_h)),
+            )
 
-            if param_group.param1:
-                self.draw_param_value(
-                    self.screen.subsurface((
-                        self.screen.get_width() - 10 - 250,
-                        status_bar_h + v_spacer, 120, top_bar_h)
-                    ),
-                    param_group.param1,
-                    (255, 128, 64),
-                )
+        if metrics.OVERLAY:
+            self.draw_metrics_overlay(self.screen)
 
-            if param_group.param2:
-                self.draw_param_value(
-                    self.screen.subsurface((
-                        self.screen.get_width() - 10 - 120,
-                        status_bar_h + v_spacer, 120, top_bar_h)
-                    ),
-                    param_group.param2,
-                    (255, 64, 128),
-                )
+        self.had_play_activity = False
+        self.had_midi_out_activity = False
+        self.midi_in_channel_activity = [False] * 16
 
-            if self.app.controls.shift_button.pressed:
-                self.draw_sequencer_banks(
-                    self.screen.subsurface((0, status_bar_h + v_spacer, 70 * 4, top_bar_h)),
-                )
+    def draw_metrics_overlay(self, surface):
+        rows = [('', 'p50', 'p99', 'max')] + [
+            (name, metrics.format_ms(p50), metrics.format_ms(p99), metrics.format_ms(max_value))
+            for name, _, p50, p99, max_value in metrics.get_summary()
+        ]
+        overlay = pygame.Surface((surface.get_width(), 12 * len(rows) + 8), pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 192))
+        for i, row in enumerate(rows):
+            y = 4 + 12 * i
+            overlay.blit(self.font_xs.render(row[0], True, (255, 255, 255)), (8, y))
+            for j, value in enumerate(row[1:]):
+                text = self.font_xs.render(value, True, (255, 255, 255))
+                overlay.blit(text, (250 + 60 * j - text.get_width(), y))
+        surface.blit(overlay, (0, surface.get_height() - overlay.get_height()))
 
-            pygame.display.flip()
-            self.had_play_activity = False
-            self.had_midi_out_activity = False
-            self.midi_in_channel_activity = [False] * 16
+    def run(self):
+        while True:
+            self.frame_scheduler.begin_frame()
+            self.app.apply_pending_values()
+            self.render_frame()
+            if self.output:
+                self.output.push(self.screen)
+            else:
+                pygame.display.flip()
+            self.frame_scheduler.end_frame()
 
             try:
-                time.sleep(1 / 30)
+                self.frame_scheduler.wait(busy=self.is_busy())
                 for event in pygame.event.get():
+                    if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                        self.frame_scheduler.wake()
                     self.app.controls.process_event(event)
                     if event.type == pygame.QUIT:
                         sys.exit()
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import deque
+
+
+class FrameScheduler:
+    def __init__(self, fps=30, idle_fps=5, idle_timeout=2, history=120):
+        self.fps = fps
+        self.idle_fps = idle_fps
+        self.idle_timeout = idle_timeout
+        self.frame_times = deque(maxlen=history)
+        self.dropped_frames = 0
+        self.last_activity = time.monotonic()
+        self.next_deadline = None
+        self.frame_start = None
+        self.frame_started = None
+        self.wake_event = threading.Event()
+
+    def wake(self):
+        self.last_activity = time.monotonic()
+        self.wake_event.set()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_activity > self.idle_timeout
+
+    def get_frame_interval(self):
+        return 1 / (self.idle_fps if self.is_idle() else self.fps)
+
+    def begin_frame(self):
+        # Cleared before rendering, so a wake that arrives during the frame still shortens the next wait
+        self.wake_event.clear()
+        self.frame_started = time.monotonic()
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        self.frame_times.append(time.perf_counter() - self.frame_start)
+
+    def wait(self, busy=False):
+        if busy:
+            self.last_activity = time.monotonic()
+
+        interval = self.get_frame_interval()
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        self.next_deadline += interval
+
+        if self.next_deadline < now:
+            # The frame overran: skip the missed slots instead of rendering a burst to catch up
+            missed = int((now - self.next_deadline) / interval) + 1
+            self.dropped_frames += missed
+            self.next_deadline += missed * interval
+
+        if self.wake_event.wait(self.next_deadline - now):
+            # Activity brings an idle-rate frame forward, but never closer than 1/fps after the previous one
+            earliest = self.next_deadline
+            if self.frame_started is not None:
+                earliest = min(earliest, self.frame_started + 1 / self.fps)
+            now = time.monotonic()
+            if earliest > now:
+                time.sleep(earliest - now)
+            self.next_deadline = max(earliest, now)
+
+    def get_stats(self):
+        times = sorted(self.frame_times)
+        if not times:
+            return None
+        return dict(
+            fps=self.idle_fps if self.is_idle() else self.fps,
+            last=self.frame_times[-1],
+            avg=sum(times) / len(times),
+            max=times[-1],
+            dropped=self.dropped_frames,
+        )
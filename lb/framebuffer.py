@@ -0,0 +1,92 @@
+import mmap
+import os
+import stat
+import pygame
+
+RGB565_MASKS = (0xF800, 0x07E0, 0x001F, 0)
+
+
+def read_sysfs_stride(path):
+    try:
+        with open(f'/sys/class/graphics/{os.path.basename(path)}/stride') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+class FramebufferOutput:
+    bytes_per_pixel = 2
+
+    def __init__(self, path='/dev/fb1', size=(800, 400), stride=None, tile_size=16):
+        self.path = path
+        self.size = size
+        self.tile_size = tile_size
+        self.stride = stride or read_sysfs_stride(path) or size[0] * self.bytes_per_pixel
+        self.buffer = pygame.Surface(size, 0, 16, RGB565_MASKS)
+        self.pitch = self.buffer.get_pitch()
+        self.previous = None
+        self.frames_pushed = 0
+        self.tiles_written = 0
+
+        length = self.stride * size[1]
+        self.fd = os.open(path, os.O_RDWR)
+        if stat.S_ISREG(os.fstat(self.fd).st_mode) and os.fstat(self.fd).st_size < length:
+            os.ftruncate(self.fd, length)
+        self.mmap = mmap.mmap(self.fd, length)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+    def get_dirty_tiles(self, frame):
+        w, h = self.size
+        ts = self.tile_size
+        row_bytes = w * self.bytes_per_pixel
+        tile_bytes = ts * self.bytes_per_pixel
+        dirty = set()
+
+        if self.previous is None:
+            return {(tx, ty) for ty in range(0, h, ts) for tx in range(0, w, ts)}
+
+        for y in range(h):
+            offset = y * self.pitch
+            if frame[offset:offset + row_bytes] == self.previous[offset:offset + row_bytes]:
+                continue
+            ty = y - y % ts
+            for x in range(0, row_bytes, tile_bytes):
+                if (x // self.bytes_per_pixel, ty) in dirty:
+                    continue
+                if frame[offset + x:offset + x + tile_bytes] != self.previous[offset + x:offset + x + tile_bytes]:
+                    dirty.add((x // self.bytes_per_pixel, ty))
+        return dirty
+
+    def push(self, surface):
+        # Blitting into a 16-bit surface makes SDL do the RGB565 conversion for the whole frame at once
+        self.buffer.blit(surface, (0, 0))
+        frame = self.buffer.get_buffer().raw
+        dirty = self.get_dirty_tiles(frame)
+
+        w, h = self.size
+        bpp = self.bytes_per_pixel
+        for ty in range(0, h, self.tile_size):
+            # Merge horizontally adjacent dirty tiles into a single span per scanline
+            spans = []
+            for tx in range(0, w, self.tile_size):
+                if (tx, ty) not in dirty:
+                    continue
+                end = min(w, tx + self.tile_size)
+                if spans and spans[-1][1] == tx:
+                    spans[-1][1] = end
+                else:
+                    spans.append([tx, end])
+
+            for y in range(ty, min(h, ty + self.tile_size)):
+                for x0, x1 in spans:
+                    src = y * self.pitch + x0 * bpp
+                    dst = y * self.stride + x0 * bpp
+                    self.mmap[dst:dst + (x1 - x0) * bpp] = frame[src:src + (x1 - x0) * bpp]
+
+        self.previous = frame
+        self.frames_pushed += 1
+        self.tiles_written += len(dirty)
+        return dirty
@@ -0,0 +1,129 @@
+import threading
+import time
+
+try:
+    import wiringpi
+except ImportError:
+    wiringpi = None
+
+INT_EDGE_FALLING = 1
+INT_EDGE_BOTH = 3
+
+MCP23017_IODIRA = 0x00
+MCP23017_GPINTENA = 0x04
+MCP23017_INTCONA = 0x08
+MCP23017_IOCON = 0x0A
+MCP23017_GPPUA = 0x0C
+MCP23017_GPIOA = 0x12
+MCP23017_IOCON_MIRROR = 0x40
+
+
+class WiringPiGPIO:
+    def __init__(self, poll_interval=1 / 1000):
+        self.poll_interval = poll_interval
+        self.pins = []
+        wiringpi.wiringPiSetup()
+
+    def setup_input(self, pin):
+        wiringpi.pinMode(pin, 0)
+        wiringpi.pullUpDnControl(pin, 2)
+        if pin not in self.pins:
+            self.pins.append(pin)
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_interval))
+
+    def read(self):
+        return {pin: wiringpi.digitalRead(pin) for pin in self.pins}
+
+
+class MCP23017GPIO:
+    def __init__(self, pin_base=100, i2c_addr=0x20, interrupt_pin=None, poll_interval=None):
+        self.pin_base = pin_base
+        self.interrupt_pin = interrupt_pin
+        if poll_interval is None:
+            poll_interval = 1 / 50 if interrupt_pin is not None else 1 / 500
+        self.poll_interval = poll_interval
+        self.native_pins = []
+        self.expander_pins = []
+        self.changed = threading.Event()
+        self.reads = 0
+
+        wiringpi.wiringPiSetup()
+        self.fd = wiringpi.wiringPiI2CSetup(i2c_addr)
+        # INTA/INTB mirrored, so a single interrupt line covers both ports
+        wiringpi.wiringPiI2CWriteReg8(self.fd, MCP23017_IOCON, MCP23017_IOCON_MIRROR)
+        wiringpi.wiringPiI2CWriteReg16(self.fd, MCP23017_IODIRA, 0xFFFF)
+        wiringpi.wiringPiI2CWriteReg16(self.fd, MCP23017_GPPUA, 0xFFFF)
+        wiringpi.wiringPiI2CWriteReg16(self.fd, MCP23017_INTCONA, 0x0000)
+
+        if interrupt_pin is not None:
+            wiringpi.pinMode(interrupt_pin, 0)
+            wiringpi.pullUpDnControl(interrupt_pin, 2)
+            wiringpi.wiringPiISR(interrupt_pin, INT_EDGE_FALLING, self.changed.set)
+
+    def is_expander_pin(self, pin):
+        return self.pin_base <= pin < self.pin_base + 16
+
+    def setup_input(self, pin):
+        if self.is_expander_pin(pin):
+            if pin not in self.expander_pins:
+                self.expander_pins.append(pin)
+            mask = 0
+            for p in self.expander_pins:
+                mask |= 1 << (p - self.pin_base)
+            wiringpi.wiringPiI2CWriteReg16(self.fd, MCP23017_GPINTENA, mask)
+        elif pin not in self.native_pins:
+            wiringpi.pinMode(pin, 0)
+            wiringpi.pullUpDnControl(pin, 2)
+            if self.interrupt_pin is not None:
+                wiringpi.wiringPiISR(pin, INT_EDGE_BOTH, self.changed.set)
+            self.native_pins.append(pin)
+
+    def wait(self, timeout):
+        self.changed.wait(min(timeout, self.poll_interval))
+        self.changed.clear()
+
+    def read(self):
+        # One 16-bit transaction reads GPIOA and GPIOB and clears a pending interrupt
+        bank = wiringpi.wiringPiI2CReadReg16(self.fd, MCP23017_GPIOA)
+        self.reads += 1
+        levels = {pin: (bank >> (pin - self.pin_base)) & 1 for pin in self.expander_pins}
+        for pin in self.native_pins:
+            levels[pin] = wiringpi.digitalRead(pin)
+        return levels
+
+
+class SimulatedGPIO:
+    def __init__(self):
+        self.levels = {}
+        self.changed = threading.Event()
+        self.reads = 0
+
+    def setup_input(self, pin):
+        self.levels.setdefault(pin, 1)
+
+    def set(self, pin, value):
+        self.levels[pin] = value
+        self.changed.set()
+
+    def press(self, pin):
+        self.set(pin, 0)
+
+    def release(self, pin):
+        self.set(pin, 1)
+
+    def turn(self, rotary, direction, step_time=0.002):
+        # Active-low quadrature sequence for one detent; the pin that goes low first sets the direction
+        first, second = (rotary.pin_clk, rotary.pin_dt) if direction == 'left' else (rotary.pin_dt, rotary.pin_clk)
+        for pin, value in [(first, 0), (second, 0), (first, 1), (second, 1)]:
+            self.set(pin, value)
+            time.sleep(step_time)
+
+    def wait(self, timeout):
+        self.changed.wait(timeout)
+        self.changed.clear()
+
+    def read(self):
+        self.reads += 1
+        return dict(self.levels)
@@ -2,34 +2,27 @@ from rx.subject import Subject
 import mido
 import threading
 import time
+from . import log, metrics
 
 
-class InternalClock(threading.Thread):
+class InternalClock:
+    # Ticked by the reactor, or by the caller under a virtual time source
     def __init__(self, app):
-        super().__init__(daemon=True)
         self.bpm = 120
         self.app = app
         self.clock = Subject()
 
-    def _wait(self, until):
-        try:
-            time.sleep(until - time.time() - 0.001)
-        except ValueError:
-            return
-        while time.time() < until:
-            pass
+    def get_tick_length(self):
+        return 60 / self.bpm / 24
 
-    def run(self):
-        while True:
-            t_last = time.time()
-            self.clock.on_next(None)
-            self._wait(t_last + 60 / self.bpm / 24)
+    def tick(self):
+        self.clock.on_next(None)
 
 
-class MidiReceiver(threading.Thread):
-    def __init__(self, port):
-        super().__init__(daemon=True)
-        self.stop_flag = False
+class MidiReceiver:
+    # rtmidi delivers messages on its own thread, they are handled on the reactor
+    def __init__(self, app, port):
+        self.app = app
         self.message = Subject()
         self.clock_found = Subject()
         self.clock = Subject()
@@ -38,36 +31,45 @@ class MidiReceiver(threading.Thread):
         self.clocks_received = None
         self.last_clock_time = None
         self.port_name = port
-        self.port = mido.open_input(port)
+        self.port = None
 
-    def run(self):
-        for message in self.port:
-            if message.type == 'songpos':
-                self.clock_set.on_next(message.pos * 24)
-                print('{}: MIDI clock set: {}'.format(self.port_name, message.pos))
-            elif message.type == 'clock':
-                if not self.last_clock_time:
-                    self.clock_found.on_next(None)
-                    self.clocks_received = 0
-                    print('{}: MIDI clock found'.format(self.port_name))
-                self.clocks_received += 1
-                self.clock.on_next(None)
-                self.last_clock_time = time.time()
-            else:
-                self.message.on_next(message)
-                print('{} -> {}'.format(self.port_name, message))
-
-            if self.stop_flag:
-                break
-
-            if self.last_clock_time and time.time() - self.last_clock_time > 1:
-                self.last_clock_time = None
-                self.clock_lost.on_next(None)
-                self.clocks_received = None
-                print('{}: MIDI clock lost'.format(self.port_name))
+    def start(self):
+        # Attached after self.port is set; mido hands the callback whatever arrived in between
+        self.port = mido.open_input(self.port_name)
+        self.port.callback = lambda message: self.app.reactor.post(self.on_message, message)
+
+    def on_message(self, message):
+        if self.port.closed:
+            return
+        if message.type == 'songpos':
+            self.clock_set.on_next(message.pos * 24)
+            log.info('clock', '{}: MIDI clock set: {}', self.port_name, message.pos)
+        elif message.type == 'clock':
+            if not self.last_clock_time:
+                self.clock_found.on_next(None)
+                self.clocks_received = 0
+                log.info('clock', '{}: MIDI clock found', self.port_name)
+            self.clocks_received += 1
+            self.clock.on_next(None)
+            self.last_clock_time = self.app.time_source.time()
+            self.app.runtime.beat(self.port_name)
+        else:
+            self.message.on_next(message)
+            log.debug('midi.in', '{} -> {}', self.port_name, message)
+
+        if self.last_clock_time and self.app.time_source.time() - self.last_clock_time > 1:
+            self.last_clock_time = None
+            self.clock_lost.on_next(None)
+            self.clocks_received = None
+            self.app.runtime.forget(self.port_name)
+            log.info('clock', '{}: MIDI clock lost', self.port_name)
 
     def stop(self):
-        self.stop_flag = True
+        self.port.close()
+        self.app.reactor.post(self.on_stop)
+
+    def on_stop(self):
+        self.app.runtime.forget(self.port_name)
         self.message.on_completed()
         if self.last_clock_time:
             self.clock_lost.on_next(None)
@@ -88,10 +90,6 @@ class InputManager(threading.Thread):
         self.clock_set = Subject()
         self.internal_clock.clock.subscribe(lambda _: self.on_internal_clock())
 
-    def start(self):
-        super().start()
-        self.internal_clock.start()
-
     def has_input(self):
         return len(self.known_ports) > 0
 
@@ -103,38 +101,43 @@ class InputManager(threading.Thread):
         if not self.active_clock:
             self.active_clock = receiver
             self.clock_found.on_next(None)
-            print('New active clock: {}'.format(receiver.port_name))
+            log.info('clock', 'New active clock: {}', receiver.port_name)
         self.clock.on_next(None)
 
     def on_clock_lost(self, receiver):
         self.active_clock = None
         self.clock_lost.on_next(None)
-        print('Lost external clock')
+        log.info('clock', 'Lost external clock')
 
+    @metrics.timed('input.on_message')
     def on_message(self, port, message):
-        for x in self.app.output_manager.recently_sent:
-            if x[1] == message and time.time() - x[0] < 0.1:
+        data = bytes(message.bytes())
+        for x in list(self.app.output_manager.recently_sent):
+            if x[1] == data and self.app.time_source.time() - x[0] < 0.1:
                 return
+        if metrics.io_latency:
+            metrics.io_latency.on_input(message)
         self.message.on_next([port, message])
 
     def run(self):
+        # Port enumeration blocks, so hotplug scanning keeps its own thread; messages are handled on the reactor
         while True:
             ports = [x for x in mido.get_input_names() if 'Through' not in x]
             if ports != self.known_ports:
                 for port in ports:
                     if port not in self.known_ports:
-                        print('Connected', port)
-                        receiver = MidiReceiver(port)
-                        receiver.start()
+                        log.info('ports', 'Connected {}', port)
+                        receiver = MidiReceiver(self.app, port)
                         receiver.message.subscribe(lambda message: self.on_message(port, message))
                         receiver.clock.subscribe(lambda _: self.on_clock(receiver))
                         receiver.clock_lost.subscribe(lambda _: self.on_clock_lost(receiver))
                         receiver.clock_set.subscribe(self.clock_set.on_next)
+                        receiver.start()
                         self.receivers[port] = receiver
 
                 for port in self.known_ports:
                     if port not in ports:
-                        print('Disconnected', port)
+                        log.info('ports', 'Disconnected {}', port)
                         if port in self.receivers:
                             self.receivers[port].stop()
                             del self.receivers[port]
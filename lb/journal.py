@@ -0,0 +1,211 @@
+import argparse
+import atexit
+import json
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+import mido
+
+# LBJ2 adds the starting state after the magic and widens MIDI payload lengths for long sysex
+MAGIC = b'LBJ2'
+
+MIDI_IN = 1
+CLOCK = 2
+CLOCK_SET = 3
+BUTTON = 4
+ROTARY = 5
+MIDI_OUT = 6
+
+HEADER = struct.Struct('<IB')
+LENGTH = struct.Struct('<I')
+
+
+class JournalRecorder:
+    # Created before App loads its state, so the state file it embeds is the one the session starts from
+    def __init__(self, app, path, flush_interval=1):
+        self.app = app
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        state = b''
+        if app.saved_state_path and os.path.exists(app.saved_state_path):
+            with open(app.saved_state_path, 'rb') as f:
+                state = f.read()
+        self.file.write(LENGTH.pack(len(state)) + state)
+        self.last_time = app.time_source.time()
+
+        im = app.input_manager
+        # The clock runs before recording starts; replay has to start from the same position
+        self.write(CLOCK_SET, struct.pack('<I', app.tempo.external_ticks))
+        im.message.subscribe(lambda x: self.write(MIDI_IN, bytes(x[1].bytes())))
+        im.clock.subscribe(lambda _: self.write(CLOCK))
+        im.clock_set.subscribe(lambda ticks: self.write(CLOCK_SET, struct.pack('<I', ticks)))
+        app.output_manager.message.subscribe(lambda data: self.write(MIDI_OUT, data))
+
+        app.controls.subscribe_events(self.on_control)
+
+        # A field recording usually ends with SIGTERM or a crash; keep the tail on disk
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        threading.Thread(target=self.run_flush, args=(flush_interval,), daemon=True).start()
+
+    def run_flush(self, interval):
+        while self.file:
+            time.sleep(interval)
+            with self.lock:
+                if self.file:
+                    self.file.flush()
+
+    def on_control(self, index, value, t):
+        if hasattr(self.app.controls.items[index], 'press'):
+            self.write(BUTTON, struct.pack('<BB', index, value))
+        else:
+            self.write(ROTARY, struct.pack('<Bb', index, value))
+
+    def write(self, type, payload=b''):
+        with self.lock:
+            if not self.file:
+                return
+            now = self.app.time_source.time()
+            delta = min(0xFFFFFFFF, int((now - self.last_time) * 1000000))
+            self.last_time += delta / 1000000
+            self.file.write(HEADER.pack(delta, type))
+            if type in (MIDI_IN, MIDI_OUT):
+                self.file.write(LENGTH.pack(len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+PAYLOAD_SIZES = {
+    CLOCK: 0,
+    CLOCK_SET: 4,
+    BUTTON: 2,
+    ROTARY: 2,
+}
+
+
+def read_header(f, path):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'{path} is not a journal')
+    return f.read(LENGTH.unpack(f.read(LENGTH.size))[0])
+
+
+def read_initial_state(path):
+    with open(path, 'rb') as f:
+        state = read_header(f, path)
+    return json.loads(state) if state else None
+
+
+def read_journal(path):
+    with open(path, 'rb') as f:
+        read_header(f, path)
+        t = 0
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            delta, type = HEADER.unpack(header)
+            t += delta / 1000000
+            if type in (MIDI_IN, MIDI_OUT):
+                payload = f.read(LENGTH.unpack(f.read(LENGTH.size))[0])
+            else:
+                payload = f.read(PAYLOAD_SIZES[type])
+            yield t, type, payload
+
+
+class JournalPlayer:
+    port_name = 'journal'
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self.output = []
+        self.expected_output = []
+        self.app.output_manager.message.subscribe(self.output.append)
+        state = read_initial_state(path)
+        if state:
+            self.app.restore_state(state)
+
+    def play(self, realtime=True):
+        time_source = self.app.time_source
+        start = time_source.time()
+
+        for t, type, payload in read_journal(self.path):
+            # A virtual time source is always advanced so scheduled transport actions fire in order
+            if realtime or time_source.virtual:
+                time_source.sleep_until(start + t)
+            self.app.reactor.post(self.dispatch, type, payload)
+        # Returns once the reactor has handled the last record
+        self.app.reactor.call(lambda: None)
+
+    def dispatch(self, type, payload):
+        im = self.app.input_manager
+        controls = self.app.controls
+        if type == MIDI_IN:
+            im.message.on_next([self.port_name, mido.Message.from_bytes(payload)])
+        elif type == CLOCK:
+            # Becoming the active clock also keeps the internal clock quiet during the replay
+            im.on_clock(self)
+        elif type == CLOCK_SET:
+            im.clock_set.on_next(struct.unpack('<I', payload)[0])
+        elif type == BUTTON:
+            controls.apply_event(*struct.unpack('<BB', payload), self.app.time_source.time())
+        elif type == ROTARY:
+            controls.apply_event(*struct.unpack('<Bb', payload), self.app.time_source.time())
+        elif type == MIDI_OUT:
+            self.expected_output.append(payload)
+
+        self.app.apply_pending_values()
+
+    def get_mismatches(self):
+        mismatches = []
+        for i in range(max(len(self.output), len(self.expected_output))):
+            expected = self.expected_output[i] if i < len(self.expected_output) else None
+            actual = self.output[i] if i < len(self.output) else None
+            if expected != actual:
+                mismatches.append((i, expected, actual))
+        return mismatches
+
+    def assert_output(self):
+        mismatches = self.get_mismatches()
+        if mismatches:
+            i, expected, actual = mismatches[0]
+            raise AssertionError(
+                f'{len(mismatches)} output messages differ from the journal, first at #{i}: '
+                f'expected {expected and expected.hex()}, got {actual and actual.hex()}'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded input journal into a headless app')
+    parser.add_argument('path')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible instead of in real time')
+    parser.add_argument('--check', action='store_true', help='fail if the output differs from the recorded output')
+    args = parser.parse_args()
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import pygame
+    from .app import App
+    from .timesource import VirtualTimeSource
+
+    pygame.mixer.init()
+    app = App(headless=True, state_path=None, time_source=VirtualTimeSource() if args.fast else None)
+    player = JournalPlayer(app, args.path)
+    player.play(realtime=not args.fast)
+    print(f'Replayed {args.path}: {len(player.output)} messages out, {len(player.expected_output)} recorded')
+    if args.check:
+        player.assert_output()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import argparse
+import json
+import random
+import threading
+import time
+import mido
+from . import log
+from .sequencer import NOTE_OFF, NOTE_ON, SequencerEvent
+from .util import percentile
+
+PORT_IN = 'lb-latency to looper'
+PORT_OUT = 'lb-latency from looper'
+
+# Pattern notes come from the sequencer on clock ticks, thru notes are echoed from the input, the ranges keep them apart
+PATTERN_NOTES = range(36, 48)
+THRU_NOTES = range(96, 108)
+
+
+class LatencyHarness:
+    def __init__(self, app, bpm=120):
+        self.app = app
+        self.bpm = bpm
+        self.send_lock = threading.Lock()
+        self.clock_times = []
+        self.thru_sent = {}
+        self.thru_latencies = []
+        self.clock_latencies = []
+        self.received = 0
+        self.running = False
+        self.output = mido.open_output(PORT_IN, virtual=True)
+        self.input = mido.open_input(PORT_OUT, virtual=True, callback=self.on_message)
+
+    def send(self, message):
+        with self.send_lock:
+            t = time.perf_counter()
+            self.output.send(message)
+        return t
+
+    def on_message(self, message):
+        t = time.perf_counter()
+        if message.type != 'note_on' or not message.velocity:
+            return
+        self.received += 1
+        if message.note in THRU_NOTES:
+            sent = self.thru_sent.pop(message.note, None)
+            if sent is not None:
+                self.thru_latencies.append(t - sent)
+        elif message.note in PATTERN_NOTES and self.clock_times:
+            self.clock_latencies.append(t - self.clock_times[-1])
+
+    def wait_for_ports(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if PORT_IN in ' '.join(self.app.input_manager.known_ports) and PORT_OUT in ' '.join(self.app.output_manager.open_ports):
+                return
+            time.sleep(0.05)
+        raise RuntimeError('The looper did not connect to the virtual ports')
+
+    def load_pattern(self):
+        s = self.app.selected_sequencer
+        s.output_channel = 1
+        s.input_channel = None
+        events = []
+        for beat in range(int(s.get_length())):
+            note = PATTERN_NOTES[beat % len(PATTERN_NOTES)]
+            events.append(SequencerEvent(beat, NOTE_ON, note, 100))
+            events.append(SequencerEvent(beat + 0.5, NOTE_OFF, note, 64))
+        s.events = events
+        s.refresh()
+        s.start()
+
+    def run_clock(self, seconds):
+        tick_length = 60 / self.bpm / 24
+        clock = mido.Message('clock')
+        next_tick = time.perf_counter()
+        end = next_tick + seconds
+        while self.running and next_tick < end:
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.clock_times.append(self.send(clock))
+            next_tick += tick_length
+
+    def run_thru(self, interval):
+        rnd = random.Random(0)
+        index = 0
+        while self.running:
+            # Random phase against the clock so the thru path is sampled between ticks as well as on them
+            time.sleep(interval * rnd.uniform(0.5, 1.5))
+            note = THRU_NOTES[index % len(THRU_NOTES)]
+            index += 1
+            self.thru_sent[note] = self.send(mido.Message('note_on', note=note, velocity=100))
+            time.sleep(interval / 4)
+            self.send(mido.Message('note_off', note=note))
+
+    def run(self, seconds=10, thru_interval=0.1):
+        self.wait_for_ports()
+        self.running = True
+        clock = threading.Thread(target=self.run_clock, args=(seconds,))
+        clock.start()
+        # Give the looper time to switch to the external clock before the pattern starts
+        time.sleep(0.5)
+        self.app.reactor.call(self.load_pattern)
+        thru = threading.Thread(target=self.run_thru, args=(thru_interval,), daemon=True)
+        thru.start()
+        clock.join()
+        self.running = False
+        time.sleep(0.2)
+
+    def get_report(self):
+        clock_intervals = [b - a for a, b in zip(self.clock_times, self.clock_times[1:])]
+        median_latency = percentile(self.clock_latencies, 50)
+        return {
+            'bpm': self.bpm,
+            'clocks_sent': len(self.clock_times),
+            'notes_received': self.received,
+            'thru_latency': summarize(self.thru_latencies),
+            'clock_to_note_latency': summarize(self.clock_latencies),
+            'clock_relative_jitter': summarize([abs(x - median_latency) for x in self.clock_latencies]),
+            'clock_send_jitter': summarize([abs(x - 60 / self.bpm / 24) for x in clock_intervals]),
+        }
+
+    def close(self):
+        self.input.close()
+        self.output.close()
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values, default=None),
+    }
+
+
+def print_report(report):
+    print(f'{report["clocks_sent"]} clocks sent at {report["bpm"]} BPM, {report["notes_received"]} notes received')
+    print('  {:<24} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name in ('thru_latency', 'clock_to_note_latency', 'clock_relative_jitter', 'clock_send_jitter'):
+        s = report[name]
+        values = ['-' if s[k] is None else f'{s[k] * 1000:.3f}' for k in ('p50', 'p90', 'p99', 'max')]
+        print('  {:<24} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(name, s['count'], *values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure MIDI latency and jitter through virtual rtmidi ports')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--bpm', type=float, default=120)
+    parser.add_argument('--thru-interval', type=float, default=0.1, help='average seconds between thru notes')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    from .app import App
+
+    # No UI, state file or metronome: only the MIDI engine runs next to the harness
+    app = App(headless=True, state_path=None, ui=False, metronome=False)
+    harness = LatencyHarness(app, bpm=args.bpm)
+    try:
+        # The looper can log every message it sends and receives; keep that out of the measurement
+        with log.muted('midi'):
+            harness.run(seconds=args.seconds, thru_interval=args.thru_interval)
+    finally:
+        harness.close()
+    report = harness.get_report()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import atexit
+import os
+import sys
+import threading
+import time
+from .metrics import Histogram, format_ms
+
+# Decided once at import: with LB_LOCK_PROFILE unset make_lock() hands out plain threading locks
+ENABLED = os.environ.get('LB_LOCK_PROFILE', '') not in ('', '0')
+REPORT_INTERVAL = float(os.environ.get('LB_LOCK_PROFILE_REPORT', '10')) if ENABLED else 0
+
+
+class LockStats:
+    # Shared by every lock created under the same name, e.g. all sixteen sequencer locks
+    def __init__(self, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = Histogram(name + '.wait')
+        self.hold = Histogram(name + '.hold')
+        self.waiting_sites = {}
+        self.holding_sites = {}
+        self.lock = threading.Lock()
+
+    def record_wait(self, site, wait):
+        with self.lock:
+            self.acquisitions += 1
+            if wait is not None:
+                self.contended += 1
+                self.wait.record(wait)
+                self.add(self.waiting_sites, site, wait)
+
+    def record_hold(self, site, hold):
+        with self.lock:
+            self.hold.record(hold)
+            self.add(self.holding_sites, site, hold)
+
+    def add(self, sites, site, t):
+        count, total, longest = sites.get(site, (0, 0, 0))
+        sites[site] = (count + 1, total + t, max(longest, t))
+
+
+stats = {}
+stats_lock = threading.Lock()
+
+
+def get_stats(name):
+    with stats_lock:
+        if name not in stats:
+            stats[name] = LockStats(name)
+        return stats[name]
+
+
+def get_site(depth):
+    frame = sys._getframe(depth + 1)
+    return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}'
+
+
+class ProfiledLock:
+    def __init__(self, name, reentrant=True):
+        self.lock = threading.RLock() if reentrant else threading.Lock()
+        self.stats = get_stats(name)
+        self.depth = 0
+        self.site = None
+        self.acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(blocking, timeout, 1)
+
+    def _acquire(self, blocking, timeout, depth):
+        wait = None
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            t = time.perf_counter()
+            if not self.lock.acquire(True, timeout):
+                return False
+            wait = time.perf_counter() - t
+        self.depth += 1
+        if self.depth == 1:
+            self.site = get_site(depth + 1)
+            self.stats.record_wait(self.site, wait)
+            self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.stats.record_hold(self.site, time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def __enter__(self):
+        self._acquire(True, -1, 1)
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def make_lock(name, reentrant=True):
+    if not ENABLED:
+        return threading.RLock() if reentrant else threading.Lock()
+    return ProfiledLock(name, reentrant=reentrant)
+
+
+def report(top=5):
+    with stats_lock:
+        items = sorted(stats.items())
+    for name, s in items:
+        if not s.acquisitions:
+            continue
+        print(
+            f'Lock {name}: {s.acquisitions} acquisitions, {s.contended} contended '
+            f'({s.contended / s.acquisitions * 100:.1f}%), '
+            f'wait p99 {format_ms(s.wait.percentile(99))} ms max {format_ms(s.wait.get_max())} ms, '
+            f'hold p99 {format_ms(s.hold.percentile(99))} ms max {format_ms(s.hold.get_max())} ms'
+        )
+        for title, sites in (('longest holders', s.holding_sites), ('longest waiters', s.waiting_sites)):
+            worst = sorted(sites.items(), key=lambda x: -x[1][2])[:top]
+            if worst:
+                print(f'  {title}:')
+            for site, (count, total, longest) in worst:
+                print(f'    {format_ms(longest):>8} ms max {format_ms(total):>10} ms total {count:7}x  {site}')
+
+
+def start_reporting():
+    if not ENABLED:
+        return
+    atexit.register(report)
+    if REPORT_INTERVAL:
+        def run():
+            while True:
+                time.sleep(REPORT_INTERVAL)
+                report()
+
+        threading.Thread(target=run, daemon=True).start()
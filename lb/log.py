@@ -0,0 +1,166 @@
+import atexit
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+MUTED = ERROR + 1
+
+
+def parse_levels(spec):
+    # e.g. "warning,midi=debug": a bare level sets the default, category=level applies to the category and its subcategories
+    default = INFO
+    levels = {}
+    for item in filter(None, (x.strip() for x in spec.split(','))):
+        category, _, level = item.rpartition('=')
+        if category:
+            levels[category] = LEVELS[level.lower()]
+        else:
+            default = LEVELS[level.lower()]
+    return default, levels
+
+
+class Log:
+    # Hot-path threads only append raw records; formatting, rate limiting and the actual write happen on the writer thread.
+    # deque appends and pops are atomic, so neither side takes a lock, and a full ring drops and counts instead of blocking.
+    def __init__(self, default_level=INFO, levels=None, capacity=4096, rate=50, interval=0.05):
+        self.default_level = default_level
+        self.levels = dict(levels or {})
+        self.thresholds = {}
+        self.capacity = capacity
+        self.rate = rate
+        self.interval = interval
+        self.records = deque()
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.window_start = time.monotonic()
+        self.window_counts = {}
+        self.suppressed = {}
+        self.writer = None
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def get_level(self, category):
+        while True:
+            if category in self.levels:
+                return self.levels[category]
+            if '.' not in category:
+                return self.default_level
+            category = category.rpartition('.')[0]
+
+    def set_level(self, category, level):
+        self.levels[category] = level
+        self.thresholds = {}
+
+    @contextlib.contextmanager
+    def muted(self, *categories):
+        previous = {c: self.levels.get(c) for c in categories}
+        for category in categories:
+            self.set_level(category, MUTED)
+        try:
+            yield
+        finally:
+            for category, level in previous.items():
+                if level is None:
+                    del self.levels[category]
+                else:
+                    self.levels[category] = level
+            self.thresholds = {}
+
+    def is_enabled(self, category, level):
+        threshold = self.thresholds.get(category)
+        if threshold is None:
+            threshold = self.thresholds[category] = self.get_level(category)
+        return level >= threshold
+
+    def log(self, category, level, fmt, args):
+        if not self.is_enabled(category, level):
+            return
+        if self.writer is None:
+            self.start()
+        if len(self.records) >= self.capacity:
+            # Unsynchronized, so concurrent overflows may undercount slightly
+            self.dropped += 1
+            return
+        self.records.append((category, level, fmt, args))
+
+    def debug(self, category, fmt, *args):
+        self.log(category, DEBUG, fmt, args)
+
+    def info(self, category, fmt, *args):
+        self.log(category, INFO, fmt, args)
+
+    def warning(self, category, fmt, *args):
+        self.log(category, WARNING, fmt, args)
+
+    def error(self, category, fmt, *args):
+        self.log(category, ERROR, fmt, args)
+
+    def start(self):
+        with self.start_lock:
+            if self.writer is not None:
+                return
+            self.writer = threading.Thread(target=self.run, name='log writer', daemon=True)
+            self.writer.start()
+            atexit.register(self.flush, True)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def format(self, level, fmt, args):
+        try:
+            text = fmt(*args) if callable(fmt) else fmt.format(*args)
+        except Exception as e:
+            text = f'{fmt!r} {args!r}: {e!r}'
+        if level >= WARNING:
+            text = f'{"ERROR" if level >= ERROR else "WARNING"}: {text}'
+        return text
+
+    def flush(self, final=False):
+        with self.flush_lock:
+            lines = []
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                lines.extend(self.get_suppressed())
+                self.window_start = now
+                self.window_counts = {}
+            while self.records:
+                category, level, fmt, args = self.records.popleft()
+                count = self.window_counts.get(category, 0)
+                # Errors always get through; everything else is limited to `rate` lines per category per second
+                if count >= self.rate and level < ERROR:
+                    self.suppressed[category] = self.suppressed.get(category, 0) + 1
+                    continue
+                self.window_counts[category] = count + 1
+                lines.append(self.format(level, fmt, args))
+            if final:
+                lines.extend(self.get_suppressed())
+            dropped = self.dropped
+            if dropped != self.reported_dropped:
+                lines.append(f'Log: {dropped - self.reported_dropped} records dropped, ring full')
+                self.reported_dropped = dropped
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+    def get_suppressed(self):
+        lines = [f'{category}: {count} messages suppressed' for category, count in sorted(self.suppressed.items())]
+        self.suppressed = {}
+        return lines
+
+
+# Decided once at import from LB_LOG (see parse_levels) and LB_LOG_RATE, in lines per category per second
+default_log = Log(*parse_levels(os.environ.get('LB_LOG', '')), rate=int(os.environ.get('LB_LOG_RATE', '50')))
+debug = default_log.debug
+info = default_log.info
+warning = default_log.warning
+error = default_log.error
+set_level = default_log.set_level
+muted = default_log.muted
+flush = default_log.flush
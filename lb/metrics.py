@@ -0,0 +1,169 @@
+import functools
+import os
+import threading
+import time
+
+# Decided once at import: with LB_METRICS unset every timed() decorator returns the function untouched
+ENABLED = os.environ.get('LB_METRICS', '') not in ('', '0')
+OVERLAY = ENABLED and os.environ.get('LB_METRICS_OVERLAY', '') not in ('', '0')
+DUMP_INTERVAL = float(os.environ.get('LB_METRICS_DUMP', '10')) if ENABLED else 0
+
+# Log-linear buckets over integer microseconds: exact below 32 us, then 16 buckets per power of two (~6% resolution)
+SUB_BITS = 5
+HALF = 1 << (SUB_BITS - 1)
+MAX_VALUE = (1 << 27) - 1
+
+
+def bucket_index(v):
+    if v >> SUB_BITS == 0:
+        return v
+    shift = v.bit_length() - SUB_BITS
+    return shift * HALF + (v >> shift)
+
+
+def bucket_value(index):
+    if index < 2 * HALF:
+        return index
+    shift = index // HALF - 1
+    return (index - shift * HALF) << shift
+
+
+class Histogram:
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (bucket_index(MAX_VALUE) + 1)
+        self.count = 0
+        self.max = 0
+
+    def record(self, seconds):
+        v = min(MAX_VALUE, max(0, int(seconds * 1000000)))
+        self.counts[bucket_index(v)] += 1
+        self.count += 1
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, q):
+        # In seconds, reported as the lower edge of the bucket holding the q-th percentile
+        if not self.count:
+            return None
+        target = max(1, q / 100 * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return bucket_value(index) / 1000000
+        return self.max / 1000000
+
+    def get_max(self):
+        return self.max / 1000000 if self.count else None
+
+
+histograms = {}
+histograms_lock = threading.Lock()
+
+
+def get_histogram(name):
+    histogram = histograms.get(name)
+    if histogram is None:
+        with histograms_lock:
+            histogram = histograms.setdefault(name, Histogram(name))
+    return histogram
+
+
+def record(name, seconds):
+    get_histogram(name).record(seconds)
+
+
+def timed(name):
+    def decorator(fx):
+        if not ENABLED:
+            return fx
+        histogram = get_histogram(name)
+
+        @functools.wraps(fx)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fx(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter() - t)
+
+        return wrapper
+    return decorator
+
+
+class ClockJitter:
+    # Difference between consecutive clock intervals, whichever clock source is active
+    def __init__(self):
+        self.last_tick = None
+        self.last_interval = None
+        self.histogram = get_histogram('clock.jitter')
+
+    def on_clock(self):
+        t = time.perf_counter()
+        if self.last_tick is not None:
+            interval = t - self.last_tick
+            if self.last_interval is not None:
+                self.histogram.record(abs(interval - self.last_interval))
+            self.last_interval = interval
+        self.last_tick = t
+
+
+class IOLatency:
+    # Matches each outgoing note on/off to the latest incoming one for the same note, e.g. the thru path.
+    # InputManager calls on_input before dispatching, since the thru output is sent from inside the dispatch.
+    def __init__(self, app):
+        self.pending = {}
+        self.histogram = get_histogram('midi.in_to_out')
+        app.output_manager.message.subscribe(self.on_output)
+
+    def on_input(self, message):
+        if message.type == 'note_on' and message.velocity:
+            self.pending[(True, message.note)] = time.perf_counter()
+        elif message.type in ('note_on', 'note_off'):
+            self.pending[(False, message.note)] = time.perf_counter()
+
+    def on_output(self, data):
+        if len(data) < 3 or data[0] & 0xE0 != 0x80:
+            return
+        t = self.pending.pop((data[0] & 0xF0 == 0x90 and data[2] > 0, data[1]), None)
+        if t is not None:
+            self.histogram.record(time.perf_counter() - t)
+
+
+io_latency = None
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.2f}'
+
+
+def get_summary():
+    with histograms_lock:
+        items = sorted(histograms.items())
+    return [
+        (name, h.count, h.percentile(50), h.percentile(99), h.get_max())
+        for name, h in items if h.count
+    ]
+
+
+def dump():
+    print(f'Metrics (ms): {"":<17} {"count":>7} {"p50":>8} {"p99":>8} {"max":>8}')
+    for name, count, p50, p99, max_value in get_summary():
+        print(f'  {name:<30} {count:7} {format_ms(p50):>8} {format_ms(p99):>8} {format_ms(max_value):>8}')
+
+
+def start(app):
+    global io_latency
+    if not ENABLED:
+        return
+    jitter = ClockJitter()
+    app.input_manager.clock.subscribe(lambda _: jitter.on_clock())
+    io_latency = IOLatency(app)
+    if DUMP_INTERVAL:
+        def run():
+            while True:
+                time.sleep(DUMP_INTERVAL)
+                dump()
+
+        threading.Thread(target=run, daemon=True).start()
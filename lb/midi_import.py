@@ -0,0 +1,127 @@
+import argparse
+import sys
+from . import log
+from .sequencer import NOTE_OFF, NOTE_ON, SequencerEvent
+from .smf import iter_tracks
+
+# Longest loop a sequencer can be set to, the range of LengthParam
+MAX_BARS = 16
+
+
+def import_smf(app, path, slots=None, by='track', start_bar=0, end_bar=None):
+    bar_size = app.tempo.bar_size
+    start = start_bar * bar_size
+    end = end_bar * bar_size if end_bar is not None else None
+    # Anything past MAX_BARS is cut off like the end of a bar range
+    limit = start + MAX_BARS * bar_size
+    cutoff = min(end, limit) if end is not None else limit
+    if slots is None:
+        slots = list(range(len(app.sequencers)))
+
+    keys = []
+    imported = {}
+    last_position = 0
+    truncated = 0
+
+    for track_index, ppq, messages in iter_tracks(path):
+        for tick, status, note, velocity in messages:
+            kind = status & 0xF0
+            if kind not in (NOTE_OFF, NOTE_ON):
+                continue
+            channel = status & 0x0F
+            key = track_index if by == 'track' else channel
+            if key not in imported:
+                if len(keys) >= len(slots):
+                    continue
+                keys.append(key)
+                imported[key] = ([], {}, channel)
+            events, open_notes, _ = imported[key]
+
+            position = tick / ppq - start
+            is_on = kind == NOTE_ON and velocity > 0
+            if is_on:
+                if position >= limit - start and (end is None or position < end - start):
+                    truncated += 1
+                if position < 0 or position >= cutoff - start or note in open_notes:
+                    continue
+                open_notes[note] = True
+                events.append(SequencerEvent(position, NOTE_ON | channel, note, velocity))
+            elif note in open_notes:
+                del open_notes[note]
+                position = min(position, cutoff - start)
+                events.append(SequencerEvent(position, NOTE_OFF | channel, note, 64))
+                last_position = max(last_position, position)
+
+    if end is None:
+        end = start + max(1, -(-last_position // bar_size)) * bar_size
+    end = min(end, limit)
+    if truncated:
+        log.warning('import', 'Only the first {} bars were imported, {} notes after them were dropped', MAX_BARS, truncated)
+
+    result = {}
+    for key, slot in zip(keys, slots):
+        events, open_notes, channel = imported[key]
+        sequencer = app.sequencers[slot]
+        length = end - start
+        with sequencer.lock:
+            sequencer.bars = int(length // bar_size)
+            sequencer.output_channel = channel + 1
+            for note in open_notes:
+                events.append(SequencerEvent(length, NOTE_OFF | channel, note, 64))
+            for event in events:
+                event.position %= length
+            events.sort(key=lambda x: x.position)
+            sequencer.events = events
+            sequencer.refresh()
+        app.sequencer_is_empty[sequencer] = False
+        result[slot] = len(events)
+    return result
+
+
+def get_problems(app, slots):
+    # What a saved import must satisfy to load and play back: a length the Length dial can show and every note closed
+    problems = []
+    for slot in slots:
+        sequencer = app.sequencers[slot]
+        if not 1 <= sequencer.bars <= MAX_BARS:
+            problems.append(f'Sequencer {slot + 1}: {sequencer.bars} bars, outside 1-{MAX_BARS}')
+        length = sequencer.get_length()
+        if any(not 0 <= event.position < length for event in sequencer.events):
+            problems.append(f'Sequencer {slot + 1}: events outside the loop')
+        if None in sequencer.get_note_offs(sequencer.events).values():
+            problems.append(f'Sequencer {slot + 1}: notes without a note-off')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load a Standard MIDI File into sequencers of a saved state')
+    parser.add_argument('path')
+    parser.add_argument('--state', default='state.json')
+    parser.add_argument('--by', choices=['track', 'channel'], default='track', help='map tracks or channels to sequencer slots')
+    parser.add_argument('--slot', type=int, action='append', help='1-based target sequencer, in order of tracks/channels found (default: 1, 2, ...)')
+    parser.add_argument('--start-bar', type=int, default=1)
+    parser.add_argument('--end-bar', type=int, help='last bar to import (inclusive)')
+    parser.add_argument('--check', action='store_true', help='reload the saved state and fail if an imported sequencer could not play it back')
+    args = parser.parse_args()
+
+    from .simulation import create_app
+
+    app = create_app(state_path=args.state)
+    result = import_smf(
+        app, args.path,
+        slots=[x - 1 for x in args.slot] if args.slot else None,
+        by=args.by,
+        start_bar=args.start_bar - 1,
+        end_bar=args.end_bar,
+    )
+    app.write_state()
+    for slot, count in result.items():
+        print(f'Sequencer {slot + 1}: {count} events, {app.sequencers[slot].bars} bars')
+    if args.check:
+        problems = get_problems(create_app(state_path=args.state), result)
+        if problems:
+            sys.exit('\n'.join(problems))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,19 @@
 import mido
 import time
 import threading
+from collections import deque
 from rx.subject import Subject
+from . import log, metrics
 
 
 class OutputManager(threading.Thread):
-    def __init__(self):
+    def __init__(self, app):
         super().__init__(daemon=True)
+        self.app = app
         self.known_ports = []
         self.open_ports = {}
         self.message = Subject()
-        self.recently_sent = []
+        self.recently_sent = deque(maxlen=50)
 
     def has_output(self):
         return len(self.known_ports) > 0
@@ -21,11 +24,11 @@ class OutputManager(threading.Thread):
             if ports != self.known_ports:
                 for port in ports:
                     if port not in self.known_ports:
-                        print('Connected output', port)
+                        log.info('ports', 'Connected output {}', port)
                         self.open_ports[port] = mido.open_output(port)
                 for port in self.known_ports:
                     if port not in ports:
-                        print('Disconnected output', port)
+                        log.info('ports', 'Disconnected output {}', port)
                         self.open_ports[port].close()
                         del self.open_ports[port]
 
@@ -33,11 +36,17 @@ class OutputManager(threading.Thread):
 
             time.sleep(0.1)
 
-    def send_to_all(self, message):
-        self.message.on_next(message)
-        self.recently_sent.append((time.time(), message))
-        self.recently_sent = self.recently_sent[-50:]
-        for port in self.open_ports.values():
-            port.send(message)
+    @metrics.timed('output.send_to_all')
+    def send_to_all(self, data):
+        self.message.on_next(data)
+        self.recently_sent.append((self.app.time_source.time(), data))
+        if self.open_ports:
+            message = mido.Message.from_bytes(data)
+            for port in self.open_ports.values():
+                port.send(message)
 
-        print('Sent', message)
+        log.debug('midi.out', format_sent, data)
+
+
+def format_sent(data):
+    return 'Sent ' + data.hex(' ').upper()
@@ -0,0 +1,54 @@
+import bisect
+
+
+class NoteIndex:
+    def __init__(self, events, length):
+        self.events = events
+        self.length = length
+
+        notes = []
+        m = {}
+        remaining_events = []
+        for event in events:
+            if event.is_note_on:
+                m[event.note] = event
+            elif event.is_note_off:
+                if event.note in m:
+                    on = m.pop(event.note)
+                    notes.append((on, event.position - on.position))
+                else:
+                    remaining_events.append(event)
+        # Note-offs that precede their note-on close a note wrapping around the loop end
+        for event in remaining_events:
+            if event.note in m:
+                on = m.pop(event.note)
+                notes.append((on, event.position + length - on.position))
+
+        self.segments = []
+        for event, note_length in notes:
+            self.segments.append((event.position, note_length, event))
+            if event.position + note_length > length:
+                self.segments.append((event.position - length, note_length, event))
+        self.segments.sort(key=lambda x: x[0])
+        self.starts = [x[0] for x in self.segments]
+        self.max_length = max((x[1] for x in self.segments), default=0)
+        self.notes = {x.note for x in events}
+
+    def get_segments_between(self, start, end):
+        i = bisect.bisect_left(self.starts, start - self.max_length)
+        j = bisect.bisect_right(self.starts, end)
+        for segment in self.segments[i:j]:
+            if segment[0] + segment[1] >= start:
+                yield segment
+
+
+def get_view_window(sequencer, position=None):
+    length = sequencer.get_length()
+    view_length = length / sequencer.zoom
+    if sequencer.scroll is None:
+        # Follow the playhead a page at a time
+        start = int((position or 0) / view_length) * view_length
+    else:
+        start = sequencer.scroll * sequencer.app.tempo.bar_size
+    start = max(0, min(start, length - view_length))
+    return start, start + view_length
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from . import log
+
+
+class Reactor(threading.Thread):
+    # The engine's one timing thread. Each pass handles, in this order: the internal clock tick if it is due, timers
+    # that are due (scheduled transport actions) by deadline, then whatever the blocking backends posted (MIDI input
+    # from rtmidi's callback threads, control changes, commands) in arrival order.
+    # Under a virtual time source the reactor never starts and everything runs on the caller's thread instead.
+    def __init__(self, app, spin=0.001):
+        super().__init__(daemon=True, name='reactor')
+        self.app = app
+        self.spin = spin
+        self.running = False
+        self.next_tick = None
+        self.timers = []
+        self.counter = itertools.count()
+        self.inbox = deque()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def post(self, fx, *args):
+        # Safe from any thread; deque appends are atomic, the pipe only wakes the loop up early
+        if not self.running:
+            fx(*args)
+            return
+        self.inbox.append((fx, args))
+        if threading.current_thread() is not self:
+            try:
+                os.write(self.wakeup_write, b'\0')
+            except BlockingIOError:
+                pass
+
+    def call(self, fx, *args):
+        # Runs fx on the loop and waits for its result, for callers that need to report errors back
+        if not self.running or threading.current_thread() is self:
+            return fx(*args)
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fx(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.post(run)
+        return future.result()
+
+    def call_later(self, delay, fx):
+        time_source = self.app.time_source
+        if time_source.virtual:
+            return time_source.call_later(delay, fx)
+        timer = (time_source.time() + max(0, delay), next(self.counter), fx)
+        if threading.current_thread() is self:
+            heapq.heappush(self.timers, timer)
+        else:
+            self.post(heapq.heappush, self.timers, timer)
+
+    def run(self):
+        self.app.runtime.setup_thread('reactor')
+        time_source = self.app.time_source
+        clock = self.app.input_manager.internal_clock
+        self.next_tick = time_source.time()
+        while True:
+            now = time_source.time()
+            if now >= self.next_tick:
+                self.app.runtime.record_clock_latency(now - self.next_tick)
+                self.dispatch(clock.tick)
+                self.app.runtime.beat('internal clock')
+                # Fall back into step rather than bursting if a tick was missed altogether
+                self.next_tick = max(self.next_tick + clock.get_tick_length(), now)
+
+            while self.timers and self.timers[0][0] <= now:
+                self.dispatch(heapq.heappop(self.timers)[2])
+
+            # Only what was already queued, so a flood of input cannot hold back the next tick
+            for _ in range(len(self.inbox)):
+                fx, args = self.inbox.popleft()
+                self.dispatch(fx, *args)
+
+            self.wait()
+
+    def dispatch(self, fx, *args):
+        try:
+            fx(*args)
+        except Exception:
+            log.error('reactor', 'Unhandled error in {}:\n{}', getattr(fx, '__qualname__', fx), traceback.format_exc())
+
+    def wait(self):
+        time_source = self.app.time_source
+        deadline = self.next_tick
+        if self.timers:
+            deadline = min(deadline, self.timers[0][0])
+        # Sleep in the selector most of the way, then spin for the last bit to avoid oversleeping
+        timeout = deadline - time_source.time() - self.spin
+        if timeout > 0 and not self.inbox:
+            if self.selector.select(timeout):
+                try:
+                    while os.read(self.wakeup_read, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        while not self.inbox and time_source.time() < deadline:
+            pass
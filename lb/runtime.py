@@ -0,0 +1,124 @@
+import gc
+import os
+import signal
+import threading
+import time
+from collections import deque
+from .util import percentile
+from .watchdog import Watchdog
+
+
+class Runtime:
+    def __init__(self, freeze_gc=False, defer_gc=False, priority=None, cpus=None, full_collect_bars=16, history=1000, report_interval=None, watchdog=None, stall_dump='stalls.txt'):
+        self.freeze_gc = freeze_gc
+        self.defer_gc = defer_gc
+        self.priority = priority
+        self.cpus = set(cpus) if cpus else None
+        self.full_collect_bars = full_collect_bars
+        self.report_interval = report_interval
+        self.app = None
+        self.last_bar = None
+        self.bars_since_full_collect = 0
+        self.gc_start = None
+        self.gc_pauses = deque(maxlen=history)
+        self.clock_latencies = deque(maxlen=history)
+        self.thread_errors = {}
+        self.watchdog = Watchdog(watchdog) if watchdog else None
+        self.stall_dump = stall_dump
+
+    def start(self, app):
+        self.app = app
+        gc.callbacks.append(self.on_gc)
+        if self.freeze_gc:
+            # Everything allocated during startup lives for the whole session; keep it out of every later collection
+            gc.collect()
+            gc.freeze()
+        if self.defer_gc:
+            gc.disable()
+            app.input_manager.clock.subscribe(lambda _: self.on_clock())
+        if self.report_interval:
+            self.start_reporting(self.report_interval)
+        if self.watchdog:
+            self.watchdog.start()
+            try:
+                signal.signal(signal.SIGUSR1, lambda *_: self.dump_stalls())
+            except ValueError:
+                # Only the main thread may install signal handlers; the control socket can still ask for a dump
+                pass
+
+    def setup_thread(self, name):
+        # Called from inside each timing thread, where pid 0 refers to the calling thread
+        threading.current_thread().name = name
+        try:
+            if self.priority is not None:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+            if self.cpus is not None:
+                os.sched_setaffinity(0, self.cpus)
+        except (AttributeError, OSError) as e:
+            if name not in self.thread_errors:
+                self.thread_errors[name] = e
+                print(f'Could not set real-time scheduling for {name}: {e}')
+
+    def on_clock(self):
+        bar = int(self.app.tempo.get_position() // self.app.tempo.bar_size)
+        if bar == self.last_bar:
+            return
+        self.last_bar = bar
+        # The downbeat has already gone out to the sequencers, so the pause lands after it
+        self.bars_since_full_collect += 1
+        if self.bars_since_full_collect >= self.full_collect_bars:
+            self.bars_since_full_collect = 0
+            gc.collect()
+        elif gc.get_count()[0]:
+            gc.collect(1)
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.gc_pauses.append((info['generation'], time.perf_counter() - self.gc_start))
+            self.gc_start = None
+
+    def record_clock_latency(self, latency):
+        self.clock_latencies.append(latency)
+
+    def beat(self, name):
+        if self.watchdog:
+            self.watchdog.beat(name)
+
+    def forget(self, name):
+        if self.watchdog:
+            self.watchdog.forget(name)
+
+    def dump_stalls(self, path=None):
+        if not self.watchdog:
+            raise RuntimeError('The watchdog is not enabled')
+        self.watchdog.dump_to_file(path or self.stall_dump)
+
+    def get_stats(self):
+        pauses = [x[1] for x in self.gc_pauses]
+        latencies = list(self.clock_latencies)
+        return {
+            'gc_pauses': len(pauses),
+            'gc_pause_p99': percentile(pauses, 99),
+            'gc_pause_max': max(pauses, default=None),
+            'clock_latency_p50': percentile(latencies, 50),
+            'clock_latency_p99': percentile(latencies, 99),
+            'clock_latency_max': max(latencies, default=None),
+        }
+
+    def report(self):
+        stats = self.get_stats()
+        ms = {k: '-' if v is None or k == 'gc_pauses' else f'{v * 1000:.2f}' for k, v in stats.items()}
+        print(
+            f'GC: {stats["gc_pauses"]} pauses, p99 {ms["gc_pause_p99"]} ms, max {ms["gc_pause_max"]} ms; '
+            f'clock latency: p50 {ms["clock_latency_p50"]} ms, p99 {ms["clock_latency_p99"]} ms, max {ms["clock_latency_max"]} ms'
+        )
+
+    def start_reporting(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.report()
+
+        threading.Thread(target=run, daemon=True).start()
@@ -1,20 +1,55 @@
+import bisect
 import mido
-import threading
-import time
-from dataclasses import dataclass, replace
 from rx.subject import Subject
+from . import metrics
+from .locks import make_lock
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
 
 
-@dataclass
 class SequencerEvent:
-    position: float
-    message: mido.Message
-    created_at: float = 0
+    __slots__ = ('position', 'status', 'note', 'velocity', 'created_at', 'source_event')
+
+    def __init__(self, position, status, note, velocity=0, created_at=None, source_event=None):
+        self.position = position
+        self.status = status
+        self.note = note
+        self.velocity = velocity
+        self.created_at = created_at
+        self.source_event = source_event
+
+    @classmethod
+    def from_message(cls, position, message):
+        data = message.bytes()
+        return cls(position, data[0], data[1] if len(data) > 1 else 0, data[2] if len(data) > 2 else 0)
+
+    @classmethod
+    def from_hex(cls, position, text):
+        return cls(position, *bytes.fromhex(text))
+
+    @property
+    def is_note_on(self):
+        return self.status & 0xF0 == NOTE_ON
+
+    @property
+    def is_note_off(self):
+        return self.status & 0xF0 == NOTE_OFF
+
+    def bytes(self):
+        return bytes((self.status, self.note, self.velocity))
+
+    def hex(self):
+        return self.bytes().hex(' ').upper()
+
+    def to_message(self):
+        return mido.Message.from_bytes(self.bytes())
+
+    def __lt__(self, other):
+        return self.position < other.position
 
     def clone(self):
-        ret = replace(self)
-        ret.source_event = self
-        return ret
+        return SequencerEvent(self.position, self.status, self.note, self.velocity, self.created_at, self)
 
 
 class BaseFilter:
@@ -33,11 +68,12 @@ class QuantizerFilter(BaseFilter):
         if not self.divisor:
             return events
         q = 4 / self.divisor
+        note_offs = self.sequencer.get_note_offs(events)
         for event in events:
-            if event.message.type == 'note_on':
+            if event.is_note_on:
                 dp = round(event.position / q) * q - event.position
                 event.position += dp
-                off = self.sequencer.get_off_event_for_on_event(events, event)
+                off = note_offs.get(id(event))
                 if off:
                     off.position += dp
         return events
@@ -47,9 +83,10 @@ class GateLengthFilter(BaseFilter):
     multiplier = 1
 
     def filter(self, events):
+        note_offs = self.sequencer.get_note_offs(events)
         for event in events:
-            if event.message.type == 'note_on':
-                off_event = self.sequencer.get_off_event_for_on_event(events, event)
+            if event.is_note_on:
+                off_event = note_offs.get(id(event))
                 if off_event:
                     length = off_event.position - event.position
                     is_wrapped = length < 0
@@ -66,9 +103,10 @@ class OffsetFilter(BaseFilter):
     offset = 0
 
     def filter(self, events):
+        note_offs = self.sequencer.get_note_offs(events)
         for event in events:
-            if event.message.type == 'note_on':
-                off_event = self.sequencer.get_off_event_for_on_event(events, event)
+            if event.is_note_on:
+                off_event = note_offs.get(id(event))
                 if off_event:
                     event.position += self.offset
                     off_event.position += self.offset
@@ -80,8 +118,10 @@ class Sequencer:
         self.app = app
 
         self.bars = 4
+        self.pending_events = None
         self.events = []
-        self.filtered_events = []
+        self._filtered_events = []
+        self.dirty = False
         self.running = False
         self.recording = False
         self.start_position = 0
@@ -91,7 +131,7 @@ class Sequencer:
         self.input_channel = None
         self.output_channel = 1
         self.output = Subject()
-        self.lock = threading.RLock()
+        self.lock = make_lock('Sequencer.lock')
 
         self.start_scheduled = False
         self.stop_scheduled = False
@@ -102,22 +142,167 @@ class Sequencer:
 
         self.thru = False
 
-        self.currently_on = {}
+        self.zoom = 1
+        self.scroll = None
+
+        self.currently_on = bytearray(128)
+
+        # Playback state for the tick path, rebuilt by refresh() and never reallocated per tick
+        self.edge_positions = []
+        self.edge_deltas = []
+        self.edge_notes = []
+        self.edge_events = []
+        self.edge_messages = []
+        self.base_counts = [0] * 128
+        self.base_events = [None] * 128
+        self.edge_count = 0
+        self.edge_cursor = 0
+        self.edge_position = None
+        self.edge_length = None
+        self.edge_channel = None
+        self.open_counts = [0] * 128
+        self.open_events = [None] * 128
+        self.open_messages = [None] * 128
+        self.off_messages = []
+        self.needs_reconcile = False
 
         self.reset()
 
         self.app.input_manager.clock.subscribe(lambda _: self.on_clock())
+        self.app.input_manager.clock_set.subscribe(lambda _: self.resync())
 
+    @metrics.timed('sequencer.on_clock')
     def on_clock(self):
-        with self.lock:
+        # Explicit acquire/release: a with block allocates bound __enter__/__exit__ methods on every tick
+        self.lock.acquire()
+        try:
+            if self.dirty or self.edge_length != self.get_length() or self.edge_channel != self.output_channel:
+                self.refresh()
             if not self.running:
-                event_map = {}
+                if self.edge_position is not None:
+                    self.close_edges()
+            elif self.edge_position is None:
+                self.seek_edges(self.get_position())
             else:
-                event_map = self.get_open_events_at_position(self.get_position(), events=self.filtered_events)
-            for n in list(event_map.keys()):
-                if event_map[n].created_at is not None and time.time() - event_map[n].created_at < 1:
-                    del event_map[n]
-            self.set_notes_on({x.message.note: x.message for x in event_map.values()})
+                self.advance_edges(self.get_position())
+            if self.needs_reconcile:
+                self.reconcile()
+        finally:
+            self.lock.release()
+
+    def build_edges(self, events):
+        # Every note is an interval from its note-on to the paired note-off; a note sounds while any of its intervals covers the playhead
+        length = self.get_length()
+        channel = self.output_channel - 1
+        note_offs = self.get_note_offs(events)
+        self.base_counts = [0] * 128
+        self.base_events = [None] * 128
+        edges = []
+        for event in events:
+            if not event.is_note_on:
+                continue
+            message = bytes((NOTE_ON | channel, event.note, event.velocity))
+            start = event.position % length
+            off = note_offs[id(event)]
+            end = off.position % length if off else start
+            if off and end == start:
+                # Zero-length notes, e.g. recorded before the sequencer was running, never sound
+                continue
+            if end < start or not off:
+                self.base_counts[event.note] += 1
+                self.base_events[event.note] = (event, message)
+            if off:
+                edges.append((start, 1, event.note, event, message))
+                edges.append((end, -1, event.note, None, None))
+        edges.sort(key=lambda x: (x[0], x[1]))
+        self.edge_positions = [x[0] for x in edges]
+        self.edge_deltas = [x[1] for x in edges]
+        self.edge_notes = [x[2] for x in edges]
+        self.edge_events = [x[3] for x in edges]
+        self.edge_messages = [x[4] for x in edges]
+        self.edge_count = len(edges)
+        self.edge_length = length
+        self.edge_channel = self.output_channel
+        self.off_messages = [bytes((NOTE_OFF | channel, note, 64)) for note in range(128)]
+        self.resync()
+
+    def resync(self):
+        self.edge_position = None
+
+    def apply_edges(self, end):
+        i = self.edge_cursor
+        while i < end:
+            note = self.edge_notes[i]
+            count = self.open_counts[note] + self.edge_deltas[i]
+            self.open_counts[note] = count
+            if self.edge_events[i] is not None:
+                self.open_events[note] = self.edge_events[i]
+                self.open_messages[note] = self.edge_messages[i]
+            elif count <= 0:
+                self.open_events[note] = None
+                self.open_messages[note] = None
+            i += 1
+        self.edge_cursor = i
+        self.needs_reconcile = True
+
+    def seek_edges(self, position):
+        self.close_edges()
+        note = 0
+        while note < 128:
+            if self.base_counts[note]:
+                self.open_counts[note] = self.base_counts[note]
+                self.open_events[note], self.open_messages[note] = self.base_events[note]
+            note += 1
+        self.edge_cursor = 0
+        self.apply_edges(bisect.bisect_right(self.edge_positions, position))
+        self.edge_position = position
+
+    def advance_edges(self, position):
+        if position < self.edge_position:
+            # Wrapped around the loop end; a full pass leaves the counts back at their base values
+            if self.edge_cursor < self.edge_count:
+                self.apply_edges(self.edge_count)
+            self.edge_cursor = 0
+        self.edge_position = position
+
+        i = self.edge_cursor
+        while i < self.edge_count and self.edge_positions[i] <= position:
+            i += 1
+        if i != self.edge_cursor:
+            self.apply_edges(i)
+
+    def close_edges(self):
+        note = 0
+        while note < 128:
+            self.open_counts[note] = 0
+            self.open_events[note] = None
+            self.open_messages[note] = None
+            note += 1
+        self.edge_position = None
+        self.needs_reconcile = True
+
+    def reconcile(self):
+        self.needs_reconcile = False
+        note = 0
+        while note < 128:
+            if self.currently_on[note] and self.open_events[note] is None \
+                    and note not in self.currently_recording_notes and note not in self.currently_open_thru_notes:
+                self.send(self.off_messages[note])
+            note += 1
+
+        now = None
+        note = 0
+        while note < 128:
+            event = self.open_events[note]
+            if event is not None and not self.currently_on[note]:
+                if now is None:
+                    now = self.app.time_source.time()
+                if event.created_at is not None and now - event.created_at < 1:
+                    # Keep retrying until a freshly recorded note is old enough to be played back
+                    self.needs_reconcile = True
+                else:
+                    self.send(self.open_messages[note])
+            note += 1
 
     def get_position(self):
         if not self.running:
@@ -137,11 +322,8 @@ class Sequencer:
         sp = int(self.app.tempo.get_position() / self.app.tempo.bar_size) + 1
         sp *= self.app.tempo.bar_size
 
-        def w():
-            time.sleep((sp - self.app.tempo.get_position()) * self.app.tempo.get_beat_time_length())
-            fx(sp)
-
-        threading.Thread(target=w).start()
+        delay = (sp - self.app.tempo.get_position()) * self.app.tempo.get_beat_time_length()
+        self.app.reactor.call_later(delay, lambda: fx(sp))
 
     def schedule_start(self):
         self.start_scheduled = True
@@ -158,6 +340,7 @@ class Sequencer:
         self.stop_scheduled = False
         self.start_position = start_position or self.app.tempo.get_position()
         self.running = True
+        self.resync()
 
     def record(self):
         if not self.running:
@@ -183,35 +366,29 @@ class Sequencer:
 
         self.off_everything()
 
-    def set_notes_on(self, map):
-        for n in list(self.currently_on.keys()):
-            if n not in map and n not in self.currently_recording_notes and n not in self.currently_open_thru_notes:
-                self.output_message(mido.Message(type='note_off', note=n))
-        for n in map:
-            if n not in self.currently_on:
-                self.output_message(map[n])
-
     def off_everything(self):
-        for n in list(self.currently_on.keys()):
-            self.output_message(mido.Message(type='note_off', note=n))
+        for n in range(128):
+            if self.currently_on[n]:
+                self.output_message(NOTE_OFF, n, 64)
+
+    def output_message(self, status, note, velocity):
+        self.send(bytes(((status & 0xF0) | (self.output_channel - 1), note, velocity)))
+        self.needs_reconcile = True
 
-    def output_message(self, message: mido.Message):
-        message = message.copy(channel=self.output_channel - 1)
-        self.output.on_next(message)
+    def send(self, data):
+        self.output.on_next(data)
 
-        if message.type == 'note_on':
-            self.currently_on[message.note] = message
-        if message.type == 'note_off':
-            if message.note in self.currently_on:
-                del self.currently_on[message.note]
+        kind = data[0] & 0xF0
+        if kind == NOTE_ON:
+            self.currently_on[data[1]] = 1
+        if kind == NOTE_OFF:
+            self.currently_on[data[1]] = 0
 
     def close_open_notes(self):
-        for note in [*self.currently_recording_notes.keys(), *self.currently_open_thru_notes.keys()]:
-            self.events.append(SequencerEvent(
-                position=self.get_position(),
-                message=mido.Message(type='note_off', note=note)
-            ))
-            self.refresh()
+        with self.lock:
+            for note in [*self.currently_recording_notes.keys(), *self.currently_open_thru_notes.keys()]:
+                bisect.insort(self.events, SequencerEvent(self.get_position(), NOTE_OFF, note, 64))
+            self.invalidate()
         self.currently_recording_notes = {}
         self.currently_open_thru_notes = {}
 
@@ -243,33 +420,39 @@ class Sequencer:
         with self.lock:
             m = {}
             for event in self.get_events_between(p + 0.1, p, events=events):
-                if event.message.type == 'note_on':
-                    m[event.message.note] = event
-                if event.message.type == 'note_off' and event.message.note in m:
-                    del m[event.message.note]
+                if event.is_note_on:
+                    m[event.note] = event
+                if event.is_note_off and event.note in m:
+                    del m[event.note]
         return m
 
     def remove_notes_between(self, note, start, end, exclude):
         with self.lock:
             if end < start:
                 end += self.get_length()
-            for event in self.events[:]:
-                if event.message.note == note and event.position >= start and event.position <= end and event != exclude:
-                    self.events.remove(event)
+            lo = bisect.bisect_left(self.events, SequencerEvent(start, 0, 0))
+            hi = bisect.bisect_right(self.events, SequencerEvent(end, 0, 0))
+            self.events[lo:hi] = [
+                event for event in self.events[lo:hi]
+                if event.note != note or event is exclude
+            ]
 
     def is_note_open(self, event):
         return event in self.currently_recording_notes.values()
 
+    @metrics.timed('sequencer.process_message')
     def process_message(self, message):
         if self.input_channel and getattr(message, 'channel', 0) != self.input_channel - 1:
             return
 
+        if message.type not in ('note_on', 'note_off'):
+            return
+
         if self.thru:
+            self.output_message(*message.bytes())
             if message.type == 'note_on':
-                self.output_message(message)
-                self.currently_open_thru_notes[message.note] = message
+                self.currently_open_thru_notes[message.note] = message.velocity
             if message.type == 'note_off':
-                self.output_message(message)
                 if message.note in self.currently_open_thru_notes:
                     del self.currently_open_thru_notes[message.note]
 
@@ -278,41 +461,79 @@ class Sequencer:
 
         with self.lock:
             position = self.get_position()
-            self.refresh()
-            if message.type in ['note_on', 'note_off']:
-                event = SequencerEvent(
-                    position=position,
-                    message=message,
-                )
-                if message.type == 'note_on':
-                    if message.note not in self.currently_recording_notes:
-                        self.currently_recording_notes[message.note] = event
-                        self.currently_on[message.note] = event
-                        # self.events.append(event)
-                if message.type == 'note_off':
-                    if message.note in self.currently_recording_notes:
-                        self.remove_notes_between(
-                            message.note,
-                            self.currently_recording_notes[message.note].position,
-                            position,
-                            self.currently_recording_notes[message.note],
-                        )
-                        self.events.append(self.currently_recording_notes[message.note])
-                        del self.currently_recording_notes[message.note]
-                        self.events.append(event)
-                    if message.note in self.currently_on:
-                        del self.currently_on[message.note]
-
-            self.refresh()
+            event = SequencerEvent.from_message(position, message)
+            if message.type == 'note_on':
+                if message.note not in self.currently_recording_notes:
+                    self.currently_recording_notes[message.note] = event
+                    self.currently_on[message.note] = 1
+            if message.type == 'note_off':
+                if message.note in self.currently_recording_notes:
+                    self.remove_notes_between(
+                        message.note,
+                        self.currently_recording_notes[message.note].position,
+                        position,
+                        self.currently_recording_notes[message.note],
+                    )
+                    bisect.insort(self.events, self.currently_recording_notes[message.note])
+                    del self.currently_recording_notes[message.note]
+                    bisect.insort(self.events, event)
+                    self.invalidate()
+                self.currently_on[message.note] = 0
+            self.needs_reconcile = True
 
     def get_off_event_for_on_event(self, events, event):
         for e in events[events.index(event):]:
-            if e.message.type == 'note_off' and e.message.note == event.message.note:
+            if e.is_note_off and e.note == event.note:
                 return e
         for e in events[:events.index(event)]:
-            if e.message.type == 'note_off' and e.message.note == event.message.note:
+            if e.is_note_off and e.note == event.note:
                 return e
 
+    def get_note_offs(self, events):
+        # Same pairing as get_off_event_for_on_event, for all note-ons in one backwards pass over the doubled list
+        note_offs = {}
+        next_off = {}
+        n = len(events)
+        for i in range(2 * n - 1, -1, -1):
+            event = events[i % n]
+            if event.is_note_off:
+                next_off[event.note] = event
+            elif i < n and event.is_note_on:
+                note_offs[id(event)] = next_off.get(event.note)
+        return note_offs
+
+    def invalidate(self):
+        self.dirty = True
+
+    @property
+    def events(self):
+        # A pattern restored with load_state(lazy=True) is decoded on first use, at the latest by the next refresh()
+        if self.pending_events is not None:
+            self.decode_pending_events()
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self.pending_events = None
+        self._events = events
+
+    def decode_pending_events(self):
+        with self.lock:
+            if self.pending_events is None:
+                return
+            pending, self.pending_events = self.pending_events, None
+            self._events = [SequencerEvent.from_hex(event['position'], event['message']) for event in pending]
+            self.dirty = True
+
+    @property
+    def filtered_events(self):
+        # Recording only marks the sequencer dirty; the filtered view is rebuilt on the next tick or read
+        with self.lock:
+            if self.dirty:
+                self.refresh()
+            return self._filtered_events
+
+    @metrics.timed('sequencer.refresh')
     def refresh(self):
         with self.lock:
             self.events = sorted(self.events, key=lambda x: x.position)
@@ -320,7 +541,9 @@ class Sequencer:
             events = self.offset_filter.filter(events)
             events = self.gate_length_filter.filter(events)
             events = self.quantizer_filter.filter(events)
-            self.filtered_events = events
+            self._filtered_events = events
+            self.dirty = False
+            self.build_edges(events)
 
     def save_state(self):
         state = {k: v for k, v in self.__dict__.items() if k in [
@@ -333,12 +556,12 @@ class Sequencer:
         for event in self.events:
             state['events'].append(dict(
                 position=event.position,
-                message=event.message.hex(),
+                message=event.hex(),
             ))
 
         return state
 
-    def load_state(self, state):
+    def load_state(self, state, lazy=False):
         for k in ['bars', 'input_channel', 'output_channel']:
             setattr(self, k, state[k])
 
@@ -346,11 +569,9 @@ class Sequencer:
         self.gate_length_filter.multiplier = state['gate_length_multiplier']
         self.offset_filter.offset = state['offset']
 
-        self.events = []
-        for event in state['events']:
-            self.events.append(SequencerEvent(
-                position=event['position'],
-                message=mido.Message.from_hex(event['message']),
-            ))
-
-        self.refresh()
+        with self.lock:
+            self.events = []
+            self.pending_events = state['events']
+            self.dirty = True
+            if not lazy:
+                self.refresh()
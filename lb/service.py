@@ -0,0 +1,48 @@
+import resource
+import threading
+import time
+from .app import App
+from .boot import BootTimeline
+from .controls import Button
+from .runtime import Runtime
+
+
+class MidiControlSurface:
+    # Maps control changes on one channel onto the control items: CC first_cc + index drives Controls.items[index].
+    # Buttons press at values >= 64 and release below; rotaries take relative values, 1-63 clockwise, 65-127 counter-clockwise.
+    def __init__(self, app, channel=16, first_cc=20):
+        self.app = app
+        self.channel = channel
+        self.first_cc = first_cc
+        app.input_manager.message.subscribe(lambda x: self.on_message(x[1]))
+
+    def on_message(self, message):
+        if message.type != 'control_change' or message.channel != self.channel - 1:
+            return
+        index = message.control - self.first_cc
+        items = self.app.controls.items
+        if not 0 <= index < len(items):
+            return
+        if isinstance(items[index], Button):
+            value = 1 if message.value >= 64 else 0
+        elif 0 < message.value < 64:
+            value = 1
+        elif message.value > 64:
+            value = -1
+        else:
+            return
+        self.app.controls.apply_event(index, value, time.monotonic())
+        self.app.apply_pending_values()
+
+
+def get_rss():
+    # Peak resident set size in MiB, ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_service(state_path='state.json', journal=None, runtime_options=None, control_channel=16, first_cc=20, control_socket=None, boot=None):
+    boot = boot or BootTimeline()
+    app = App(headless=True, state_path=state_path, journal=journal, runtime=Runtime(**(runtime_options or {})), ui=False, metronome=False, control_socket=control_socket, boot=boot)
+    MidiControlSurface(app, channel=control_channel, first_cc=first_cc)
+    print(f'Engine ready in {boot.now() * 1000:.0f} ms, {get_rss():.1f} MiB RSS')
+    threading.Event().wait()
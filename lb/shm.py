@@ -0,0 +1,94 @@
+import struct
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedRing:
+    # Single producer, single consumer. Each slot starts with a sequence number that the producer writes last,
+    # so the consumer never needs a separate head index to be visible in order.
+    SEQ = struct.Struct('<I')
+    TAIL = struct.Struct('<I')
+
+    def __init__(self, record_format, capacity=256, name=None, create=False):
+        self.record = struct.Struct(record_format)
+        self.capacity = capacity
+        self.slot_size = self.SEQ.size + self.record.size
+        self.shm = SharedMemory(name=name, create=create, size=self.TAIL.size + capacity * self.slot_size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        if create:
+            self.buf[:self.TAIL.size + capacity * self.slot_size] = bytes(self.TAIL.size + capacity * self.slot_size)
+
+    def get_offset(self, seq):
+        return self.TAIL.size + (seq % self.capacity) * self.slot_size
+
+    def write(self, *values):
+        tail = self.TAIL.unpack_from(self.buf, 0)[0]
+        if self.head - tail >= self.capacity:
+            self.dropped += 1
+            return False
+        offset = self.get_offset(self.head)
+        self.record.pack_into(self.buf, offset + self.SEQ.size, *values)
+        self.head += 1
+        self.SEQ.pack_into(self.buf, offset, self.head & 0xFFFFFFFF)
+        return True
+
+    def read(self):
+        while True:
+            offset = self.get_offset(self.tail)
+            if self.SEQ.unpack_from(self.buf, offset)[0] != (self.tail + 1) & 0xFFFFFFFF:
+                return
+            values = self.record.unpack_from(self.buf, offset + self.SEQ.size)
+            self.tail += 1
+            self.TAIL.pack_into(self.buf, 0, self.tail & 0xFFFFFFFF)
+            yield values
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class StateBlock:
+    # Seqlock: the version is odd while a write is in progress, readers retry until they copy a stable payload
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, size=65536, name=None, create=False):
+        self.size = size
+        self.shm = SharedMemory(name=name, create=create, size=self.HEADER.size + size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.version = 0
+        if create:
+            self.HEADER.pack_into(self.buf, 0, 0, 0)
+
+    def write(self, data):
+        if len(data) > self.size:
+            raise ValueError(f'State of {len(data)} bytes does not fit in a {self.size} byte block')
+        self.version += 1
+        self.HEADER.pack_into(self.buf, 0, self.version, 0)
+        self.buf[self.HEADER.size:self.HEADER.size + len(data)] = data
+        self.version += 1
+        self.HEADER.pack_into(self.buf, 0, self.version, len(data))
+
+    def get_version(self):
+        return self.HEADER.unpack_from(self.buf, 0)[0]
+
+    def read(self):
+        while True:
+            version, length = self.HEADER.unpack_from(self.buf, 0)
+            if not version % 2:
+                data = bytes(self.buf[self.HEADER.size:self.HEADER.size + length])
+                if self.get_version() == version:
+                    return version, data
+            time.sleep(0)
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -0,0 +1,35 @@
+import os
+from .timesource import VirtualTimeSource
+
+
+def create_app(**kwargs):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import pygame
+    from .app import App
+
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    kwargs.setdefault('state_path', None)
+    return App(headless=True, time_source=VirtualTimeSource(), **kwargs)
+
+
+class Simulation:
+    def __init__(self, app):
+        self.app = app
+        self.time_source = app.time_source
+        self.clock = app.input_manager.internal_clock
+
+    def tick(self):
+        self.clock.tick()
+        self.time_source.advance(self.clock.get_tick_length())
+
+    def run_ticks(self, ticks):
+        for _ in range(ticks):
+            self.tick()
+
+    def run_beats(self, beats):
+        self.run_ticks(int(beats * 24))
+
+    def run_bars(self, bars):
+        self.run_beats(bars * self.app.tempo.bar_size)
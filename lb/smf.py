@@ -0,0 +1,111 @@
+import struct
+
+
+def encode_varint(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+class SMFWriter:
+    def __init__(self, path, ppq=480):
+        self.ppq = ppq
+        self.file = open(path, 'wb')
+        self.file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, ppq))
+        self.file.write(b'MTrk')
+        self.length_offset = self.file.tell()
+        self.file.write(struct.pack('>I', 0))
+        self.track_length = 0
+        self.last_tick = 0
+        self.running_status = None
+
+    def _write_event(self, tick, data):
+        delta = encode_varint(max(0, tick - self.last_tick))
+        self.last_tick = max(self.last_tick, tick)
+        self.file.write(delta)
+        self.file.write(data)
+        self.track_length += len(delta) + len(data)
+
+    def write_message(self, tick, data):
+        if data[0] == self.running_status:
+            data = data[1:]
+        else:
+            self.running_status = data[0]
+        self._write_event(tick, bytes(data))
+
+    def write_meta(self, tick, type, data):
+        self.running_status = None
+        self._write_event(tick, bytes([0xFF, type]) + encode_varint(len(data)) + data)
+
+    def write_tempo(self, tick, bpm):
+        self.write_meta(tick, 0x51, struct.pack('>I', round(60000000 / bpm))[1:])
+
+    def close(self, tick=None):
+        self.write_meta(self.last_tick if tick is None else tick, 0x2F, b'')
+        self.file.seek(self.length_offset)
+        self.file.write(struct.pack('>I', self.track_length))
+        self.file.close()
+
+
+def read_varint(data, offset):
+    value = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value = (value << 7) | (b & 0x7F)
+        if not b & 0x80:
+            return value, offset
+
+
+def iter_track_messages(data):
+    tick = 0
+    offset = 0
+    status = None
+    while offset < len(data):
+        delta, offset = read_varint(data, offset)
+        tick += delta
+        if data[offset] & 0x80:
+            status = data[offset]
+            offset += 1
+
+        if status == 0xFF:
+            offset += 1
+            length, offset = read_varint(data, offset)
+            offset += length
+            status = None
+        elif status in (0xF0, 0xF7):
+            length, offset = read_varint(data, offset)
+            offset += length
+            status = None
+        elif status & 0xF0 in (0xC0, 0xD0):
+            yield tick, status, data[offset], 0
+            offset += 1
+        else:
+            yield tick, status, data[offset], data[offset + 1]
+            offset += 2
+
+
+def iter_tracks(path):
+    with open(path, 'rb') as f:
+        chunk_type, length = struct.unpack('>4sI', f.read(8))
+        if chunk_type != b'MThd':
+            raise ValueError(f'{path} is not a Standard MIDI File')
+        _, track_count, division = struct.unpack('>HHH', f.read(6))
+        f.seek(length - 6, 1)
+        if division & 0x8000:
+            raise ValueError('SMPTE time division is not supported')
+
+        index = 0
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            chunk_type, length = struct.unpack('>4sI', header)
+            if chunk_type != b'MTrk':
+                f.seek(length, 1)
+                continue
+            yield index, division, iter_track_messages(f.read(length))
+            index += 1
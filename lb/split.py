@@ -0,0 +1,404 @@
+import atexit
+import marshal
+import multiprocessing
+import os
+import threading
+import time
+from rx.subject import Subject
+from .controls import Controls
+from .runtime import Runtime
+from .sequencer import QuantizerFilter, SequencerEvent
+from .shm import SharedRing, StateBlock
+from .tempo import Tempo
+from .timesource import RealTimeSource
+from .util import IndexedOptions
+
+# Control item index, value (1/0 for buttons, -1/1 for rotaries), monotonic timestamp
+COMMAND_FORMAT = '<Bbd'
+
+STATE_SIZE = 64 * 1024
+PATTERN_SIZE = 8 * 1024 * 1024
+
+
+def describe_param(param):
+    if not param:
+        return None
+    return (param.name, param.type, list(param.options), [param.to_str(x) for x in param.options])
+
+
+class EngineBridge:
+    def __init__(self, app, commands, state, pattern, wakeup, interval=1 / 60):
+        self.app = app
+        self.commands = commands
+        self.state = state
+        self.pattern = pattern
+        self.wakeup = wakeup
+        self.interval = interval
+        self.pattern_key = None
+        self.midi_in = 0
+        self.midi_in_channels = [0] * 16
+        self.midi_out = 0
+
+        app.input_manager.message.subscribe(lambda x: self.on_midi_in(x[1]))
+        app.output_manager.message.subscribe(lambda _: self.on_midi_out())
+
+    def on_midi_in(self, message):
+        self.midi_in += 1
+        if hasattr(message, 'channel'):
+            self.midi_in_channels[message.channel] += 1
+
+    def on_midi_out(self):
+        self.midi_out += 1
+
+    def run(self):
+        while True:
+            self.wakeup.acquire(timeout=self.interval)
+            commands = list(self.commands.read())
+            if commands:
+                self.app.reactor.post(self.apply_commands, commands)
+            self.publish()
+
+    def apply_commands(self, commands):
+        for index, value, t in commands:
+            self.app.controls.apply_event(index, value, t)
+        self.app.apply_pending_values()
+
+    def get_current_group(self):
+        app = self.app
+        groups = app.scope_param_groups[app.current_scope]
+        group = app.current_param_group.get(app.current_scope)
+        return groups.index(group) if group in groups else 0
+
+    def publish(self):
+        app = self.app
+        sequencer = app.selected_sequencer
+        group_index = self.get_current_group()
+        group = app.scope_param_groups[app.current_scope][group_index]
+
+        with sequencer.lock:
+            events = sequencer.filtered_events
+            key = (id(sequencer), id(events), len(events), app.current_scope, group_index, id(app.selected_event))
+            if key != self.pattern_key:
+                self.pattern_key = key
+                self.publish_pattern(sequencer, events, group_index, group)
+            recording_notes = [(e.position, e.note, e.velocity) for e in sequencer.currently_recording_notes.values()]
+
+        self.state.write(marshal.dumps({
+            'position': app.tempo.get_position(),
+            'bpm': app.tempo.bpm,
+            'bar_size': app.tempo.bar_size,
+            'has_input': app.input_manager.has_input(),
+            'external_clock': bool(app.input_manager.active_clock),
+            'has_output': app.output_manager.has_output(),
+            'midi_in': self.midi_in,
+            'midi_in_channels': list(self.midi_in_channels),
+            'midi_out': self.midi_out,
+            'sequencers': [
+                (
+                    s.running, s.recording, s.start_scheduled, s.stop_scheduled,
+                    s.get_position(), s.get_length(), s.output_channel, app.sequencer_is_empty[s],
+                    s.zoom, s.scroll, s.quantizer_filter.divisor,
+                )
+                for s in app.sequencers
+            ],
+            'selected': app.sequencers.index(sequencer),
+            'bank': app.selected_sequencer_bank,
+            'scope': app.current_scope,
+            'group': group_index,
+            # Formatted here as well: values such as a wrapped note length or an external BPM are not among the options
+            'values': [(p.get(), p.is_on(), p.to_str(p.get())) if p else None for p in (group.param1, group.param2)],
+            'recording_notes': recording_notes,
+        }))
+
+    def publish_pattern(self, sequencer, events, group_index, group):
+        app = self.app
+        selected_event = -1
+        if app.selected_event is not None:
+            for i, e in enumerate(events):
+                if e.source_event is app.selected_event:
+                    selected_event = i
+                    break
+        pattern = {
+            'sequencer': app.sequencers.index(sequencer),
+            'events': [(e.position, e.status, e.note, e.velocity) for e in events],
+            'selected_event': selected_event,
+            'groups': {scope: [g.name for g in groups] for scope, groups in app.scope_param_groups.items()},
+            'scope': app.current_scope,
+            'group': group_index,
+            'params': [describe_param(group.param1), describe_param(group.param2)],
+        }
+        while True:
+            try:
+                self.pattern.write(marshal.dumps(pattern))
+                return
+            except ValueError:
+                # Show as much of a huge pattern as fits rather than none of it
+                pattern['events'] = pattern['events'][:len(pattern['events']) // 2]
+
+
+def run_engine(names, state_path, journal, runtime_options, wakeup, control_socket=None):
+    cpus = runtime_options.get('cpus')
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            print(f'Could not pin the engine process: {e}')
+
+    # SDL would otherwise trap SIGTERM and the engine could not be stopped from the UI process
+    os.environ.setdefault('SDL_NO_SIGNAL_HANDLERS', '1')
+    import pygame
+    from .app import App
+
+    pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=256)
+    commands = SharedRing(COMMAND_FORMAT, name=names['commands'])
+    state = StateBlock(STATE_SIZE, name=names['state'])
+    pattern = StateBlock(PATTERN_SIZE, name=names['pattern'])
+    app = App(headless=True, state_path=state_path, journal=journal, runtime=Runtime(**runtime_options), ui=False, control_socket=control_socket)
+    EngineBridge(app, commands, state, pattern, wakeup).run()
+
+
+class MirrorTempo:
+    bars = Tempo.bars
+    pos_to_q = Tempo.pos_to_q
+    get_q = Tempo.get_q
+
+    def __init__(self):
+        self.bpm = 120
+        self.bar_size = Tempo.bar_size
+        self.position = 0
+
+    def get_position(self):
+        return self.position
+
+
+class MirrorInputManager:
+    def __init__(self):
+        self.message = Subject()
+        self.active_clock = None
+        self.input = False
+
+    def has_input(self):
+        return self.input
+
+
+class MirrorOutputManager:
+    def __init__(self):
+        self.message = Subject()
+        self.output = False
+
+    def has_output(self):
+        return self.output
+
+
+class MirrorSequencer:
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.RLock()
+        self.running = False
+        self.recording = False
+        self.start_scheduled = False
+        self.stop_scheduled = False
+        self.position = 0
+        self.length = 16
+        self.output_channel = 1
+        self.zoom = 1
+        self.scroll = None
+        self.quantizer_filter = QuantizerFilter(app, self)
+        self.filtered_events = []
+        self.currently_recording_notes = {}
+
+    def get_position(self):
+        return self.position
+
+    def get_length(self):
+        return self.length
+
+    def normalize_position(self, p):
+        return (p + self.get_length()) % self.get_length()
+
+
+class MirrorParam:
+    def __init__(self, name, type, options, strings):
+        self.name = name
+        self.type = type
+        self.options = IndexedOptions(options)
+        self.strings = strings
+        self.value = options[0] if options else None
+        self.text = None
+        self.on = True
+
+    def get(self):
+        return self.value
+
+    def is_on(self):
+        return self.on
+
+    def to_str(self, v):
+        if v == self.value and self.text is not None:
+            return self.text
+        if v in self.options:
+            return self.strings[self.options.index(v)]
+        return str(v)
+
+
+class MirrorParamGroup:
+    def __init__(self, name):
+        self.name = name
+        self.param1 = None
+        self.param2 = None
+
+
+class MirrorApp:
+    # Stands in for App in the UI process, exposing what Display reads from the engine's published state
+    def __init__(self, state, pattern, gpio=None, timeout=30):
+        self.state = state
+        self.pattern = pattern
+        self.time_source = RealTimeSource()
+        self.runtime = Runtime()
+        self.reactor = None
+        self.tempo = MirrorTempo()
+        self.input_manager = MirrorInputManager()
+        self.output_manager = MirrorOutputManager()
+        self.controls = Controls(self, gpio=gpio)
+        self.display = None
+
+        self.sequencer_bank_size = len(self.controls.number_buttons)
+        self.sequencer_banks = len(self.controls.number_buttons)
+        self.sequencers = [MirrorSequencer(self) for _ in range(self.sequencer_banks * self.sequencer_bank_size)]
+        self.sequencer_is_empty = {s: True for s in self.sequencers}
+        self.selected_sequencer = self.sequencers[0]
+        self.selected_sequencer_bank = 0
+        self.selected_event = None
+        self.current_scope = 'sequencer'
+        self.scope_param_groups = {}
+        self.current_param_group = {}
+        self.pattern_scope = None
+        self.pattern_version = None
+        self.midi_in = 0
+        self.midi_in_channels = [0] * 16
+        self.midi_out = 0
+
+        deadline = time.monotonic() + timeout
+        while not state.get_version() or not pattern.get_version():
+            if time.monotonic() > deadline:
+                raise RuntimeError('The engine process did not publish any state')
+            time.sleep(0.05)
+        self.sync()
+
+    def apply_pending_values(self):
+        # Display calls this at the start of every frame; value changes are applied by the engine
+        self.sync()
+
+    def sync(self):
+        if self.pattern.get_version() != self.pattern_version:
+            self.pattern_version, data = self.pattern.read()
+            self.apply_pattern(marshal.loads(data))
+        self.apply_state(marshal.loads(self.state.read()[1]))
+
+    def apply_pattern(self, pattern):
+        sequencer = self.sequencers[pattern['sequencer']]
+        events = []
+        for position, status, note, velocity in pattern['events']:
+            event = SequencerEvent(position, status, note, velocity)
+            event.source_event = event
+            events.append(event)
+        with sequencer.lock:
+            sequencer.filtered_events = events
+        index = pattern['selected_event']
+        self.selected_event = events[index] if index >= 0 else None
+
+        self.scope_param_groups = {
+            scope: [MirrorParamGroup(name) for name in names]
+            for scope, names in pattern['groups'].items()
+        }
+        group = self.scope_param_groups[pattern['scope']][pattern['group']]
+        group.param1, group.param2 = [MirrorParam(*x) if x else None for x in pattern['params']]
+        self.pattern_scope = (pattern['scope'], pattern['group'])
+        self.current_scope = pattern['scope']
+        self.current_param_group = {scope: groups[0] for scope, groups in self.scope_param_groups.items() if groups}
+        self.current_param_group[pattern['scope']] = group
+
+    def apply_state(self, state):
+        self.tempo.position = state['position']
+        self.tempo.bpm = state['bpm']
+        self.tempo.bar_size = state['bar_size']
+        self.input_manager.input = state['has_input']
+        self.input_manager.active_clock = state['external_clock'] or None
+        self.output_manager.output = state['has_output']
+
+        for s, values in zip(self.sequencers, state['sequencers']):
+            (
+                s.running, s.recording, s.start_scheduled, s.stop_scheduled,
+                s.position, s.length, s.output_channel, self.sequencer_is_empty[s],
+                s.zoom, s.scroll, s.quantizer_filter.divisor,
+            ) = values
+        self.selected_sequencer = self.sequencers[state['selected']]
+        self.selected_sequencer_bank = state['bank']
+
+        # Values only apply once the pattern block describing the same parameters has been read
+        if (state['scope'], state['group']) == self.pattern_scope:
+            group = self.current_param_group[self.current_scope]
+            for param, value in zip((group.param1, group.param2), state['values']):
+                if param and value:
+                    param.value, param.on, param.text = value
+
+        with self.selected_sequencer.lock:
+            self.selected_sequencer.currently_recording_notes = {
+                note: SequencerEvent(position, 0x90, note, velocity)
+                for position, note, velocity in state['recording_notes']
+            }
+
+        channels = state['midi_in_channels']
+        for channel in range(16):
+            if channels[channel] != self.midi_in_channels[channel]:
+                self.input_manager.message.on_next([None, MidiActivity(channel)])
+        if state['midi_in'] != self.midi_in and channels == self.midi_in_channels:
+            self.input_manager.message.on_next([None, None])
+        if state['midi_out'] != self.midi_out:
+            self.output_manager.message.on_next(None)
+        self.midi_in = state['midi_in']
+        self.midi_in_channels = channels
+        self.midi_out = state['midi_out']
+
+
+class MidiActivity:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+def run_split(framebuffer=None, gpio=None, journal=None, state_path='state.json', runtime_options=None, control_socket=None):
+    from .display import Display
+    from .framebuffer import FramebufferOutput
+
+    runtime_options = runtime_options or {}
+    cpus = runtime_options.get('cpus')
+    if cpus:
+        ui_cpus = os.sched_getaffinity(0) - set(cpus)
+        if ui_cpus:
+            os.sched_setaffinity(0, ui_cpus)
+
+    ctx = multiprocessing.get_context('spawn')
+    commands = SharedRing(COMMAND_FORMAT, create=True)
+    state = StateBlock(STATE_SIZE, create=True)
+    pattern = StateBlock(PATTERN_SIZE, create=True)
+    for block in (commands, state, pattern):
+        atexit.register(block.close, unlink=True)
+
+    wakeup = ctx.Semaphore(0)
+    names = {'commands': commands.name, 'state': state.name, 'pattern': pattern.name}
+    engine = ctx.Process(target=run_engine, args=(names, state_path, journal, runtime_options, wakeup, control_socket), daemon=True)
+    engine.start()
+
+    app = MirrorApp(state, pattern, gpio=gpio)
+
+    def send(index, value, t):
+        if commands.write(index, value, t):
+            wakeup.release()
+
+    app.controls.subscribe_events(send)
+
+    output = FramebufferOutput(framebuffer) if framebuffer else None
+    app.display = Display(app, output=output)
+    app.display.setup()
+    app.controls.start()
+    app.display.run()
@@ -0,0 +1,41 @@
+import random
+from .sequencer import NOTE_OFF, NOTE_ON, SequencerEvent
+
+
+def make_pattern(sequencer, notes=64, polyphony=4, wrap=True, zero_length=0, seed=0):
+    rnd = random.Random(seed)
+    length = sequencer.get_length()
+    events = []
+    for i in range(notes):
+        voice = i % polyphony
+        position = length * (i // polyphony) / max(1, notes // polyphony)
+        duration = rnd.uniform(0.1, 1)
+        if wrap and i == notes - 1:
+            position = length - duration / 2
+        note = 36 + voice * 7 + rnd.randrange(7)
+        events.append(SequencerEvent(position, NOTE_ON, note, rnd.randrange(1, 128)))
+        events.append(SequencerEvent((position + duration) % length, NOTE_OFF, note, 64))
+    for i in range(zero_length):
+        position = length * (i + 0.5) / zero_length
+        note = 100 + i % 20
+        events.append(SequencerEvent(position, NOTE_ON, note, 100))
+        events.append(SequencerEvent(position, NOTE_OFF, note, 64))
+    return events
+
+
+def load_session(app, sequencers=16, notes=256, polyphony=8, bars=4, recording=True, wrap=True, zero_length=2, seed=0):
+    for index, s in enumerate(app.sequencers[:sequencers]):
+        s.bars = bars
+        s.output_channel = index % 16 + 1
+        s.events = make_pattern(s, notes=notes, polyphony=polyphony, wrap=wrap, zero_length=zero_length, seed=seed + index)
+        s.quantizer_filter.divisor = [None, 16, 8][index % 3]
+        s.gate_length_filter.multiplier = [1, 0.5, 1.5][index % 3]
+        s.refresh()
+        s.running = True
+        app.sequencer_is_empty[s] = False
+
+    if recording:
+        s = app.selected_sequencer
+        s.recording = True
+        for note in range(60, 60 + polyphony):
+            s.currently_recording_notes[note] = SequencerEvent(s.get_position(), NOTE_ON, note, 100)
@@ -1,21 +1,16 @@
-import pygame
-import time
-import threading
-
-
-class Tempo(threading.Thread):
+class Tempo:
     bar_size = 4
     bars = 4
     enable_metronome = False
     last_beat_time = None
     external_ticks = 0
 
-    def __init__(self, app):
-        super().__init__(daemon=True)
+    def __init__(self, app, metronome=True):
         self.reset()
         self.app = app
-        self.metronome_sound = pygame.mixer.Sound('metronome.wav')
-        self.metronome_b_sound = pygame.mixer.Sound('metronome_b.wav')
+        self.metronome = metronome
+        self.metronome_sound = None
+        self.metronome_b_sound = None
         self.app.input_manager.clock_set.subscribe(self.on_clock_set)
         self.app.input_manager.clock.subscribe(lambda _: self.on_clock())
 
@@ -45,17 +40,24 @@ class Tempo(threading.Thread):
     def get_bar_time_length(self):
         return 60 / self.bpm * self.bar_size
 
-    def run(self):
-        while True:
-            next_tick = self.position_to_time(round(self.get_position()) + 1)
-            time.sleep(next_tick - self.get_time())
-            q = self.pos_to_q(round(self.get_position()))
-            if self.enable_metronome:
-                if q[2] == 1:
-                    self.metronome_b_sound.play()
-                else:
-                    self.metronome_sound.play()
-            time.sleep(self.metronome_sound.get_length())
+    def load_sounds(self):
+        import pygame
+        self.app.boot.join('mixer')
+        self.metronome_sound = pygame.mixer.Sound('metronome.wav')
+        self.metronome_b_sound = pygame.mixer.Sound('metronome_b.wav')
+
+    def start(self):
+        if self.metronome:
+            self.app.boot.start('metronome', self.load_sounds)
+
+    def play_metronome(self):
+        # metronome_b_sound is loaded last, so once it is there both are
+        if not self.enable_metronome or not self.metronome_b_sound:
+            return
+        if self.pos_to_q(self.get_position())[2] == 1:
+            self.metronome_b_sound.play()
+        else:
+            self.metronome_sound.play()
 
     def reset(self):
         self.last_beat_time = None
@@ -64,11 +66,12 @@ class Tempo(threading.Thread):
     def on_clock(self):
         if self.external_ticks % 24 == 0:
             lbt = self.last_beat_time
-            self.last_beat_time = time.time()
+            self.last_beat_time = self.app.time_source.time()
             if lbt:
-                dt = time.time() - lbt
+                dt = self.last_beat_time - lbt
                 bpm = 60 / dt
                 self.bpm = bpm
+            self.play_metronome()
         self.external_ticks += 1
 
     def on_clock_set(self, ticks):
@@ -0,0 +1,64 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class RealTimeSource:
+    virtual = False
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def sleep_until(self, t):
+        # Sleep most of the way, then spin for the last millisecond to avoid oversleeping
+        try:
+            time.sleep(t - time.monotonic() - 0.001)
+        except ValueError:
+            return
+        while time.monotonic() < t:
+            pass
+
+    def call_later(self, delay, fx):
+        timer = threading.Timer(max(0, delay), fx)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class VirtualTimeSource:
+    virtual = True
+
+    def __init__(self, start=0):
+        self.now = start
+        self.timers = []
+        self.counter = itertools.count()
+        self.lock = threading.RLock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def sleep_until(self, t):
+        self.advance_to(t)
+
+    def call_later(self, delay, fx):
+        with self.lock:
+            heapq.heappush(self.timers, (self.now + max(0, delay), next(self.counter), fx))
+
+    def advance(self, seconds):
+        self.advance_to(self.now + max(0, seconds))
+
+    def advance_to(self, t):
+        with self.lock:
+            while self.timers and self.timers[0][0] <= t:
+                due, _, fx = heapq.heappop(self.timers)
+                self.now = max(self.now, due)
+                fx()
+            self.now = max(self.now, t)
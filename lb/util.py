@@ -1,3 +1,5 @@
+import math
+
 NOTES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 NOTES_IN_OCTAVE = len(NOTES)
 
@@ -8,21 +10,52 @@ def number_to_note(number: int):
     return note, octave
 
 
-def list_next(lst, item):
+class IndexedOptions(list):
+    def __init__(self, items):
+        super().__init__(items)
+        self._index = {}
+        for i, item in enumerate(self):
+            self._index.setdefault(item, i)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def index(self, item):
+        try:
+            return self._index[item]
+        except KeyError:
+            raise ValueError(f'{item!r} is not in list')
+
+
+def list_step(lst, item, steps):
     if not len(lst):
         return None
     if item not in lst:
         return lst[0]
     i = lst.index(item)
-    i = min(len(lst) - 1, i + 1)
+    i = max(0, min(len(lst) - 1, i + steps))
     return lst[i]
 
 
+def list_next(lst, item):
+    return list_step(lst, item, 1)
+
+
 def list_prev(lst, item):
-    if not len(lst):
+    return list_step(lst, item, -1)
+
+
+def rotary_acceleration(interval, option_count, threshold=0.08):
+    if interval is None or interval >= threshold or option_count < 16:
+        return 1
+    # Quadratic in detent rate, scaled so that a fast spin crosses a long list in about a turn
+    steps = (threshold / interval) ** 2 * option_count / 64
+    return max(1, min(option_count // 8, int(steps)))
+
+
+def percentile(values, q):
+    if not len(values):
         return None
-    if item not in lst:
-        return lst[0]
-    i = lst.index(item)
-    i = max(0, i - 1)
-    return lst[i]
+    values = sorted(values)
+    i = min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))
+    return values[i]
@@ -0,0 +1,105 @@
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class Stall:
+    def __init__(self, name, started, gap, stacks):
+        self.name = name
+        self.started = started
+        self.wall_time = time.time() - (time.perf_counter() - started)
+        self.gap = gap
+        self.ongoing = True
+        self.stacks = stacks
+
+
+class WatchedThread:
+    __slots__ = ('last_beat', 'stall')
+
+    def __init__(self, t):
+        self.last_beat = t
+        self.stall = None
+
+
+class Watchdog(threading.Thread):
+    # Timing threads call beat() on every tick; a thread that misses the threshold gets every thread's stack captured
+    def __init__(self, threshold=0.05, history=32):
+        super().__init__(daemon=True, name='watchdog')
+        self.threshold = threshold
+        self.watched = {}
+        self.stalls = deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def beat(self, name):
+        t = time.perf_counter()
+        watched = self.watched.get(name)
+        if watched is None:
+            self.watched[name] = WatchedThread(t)
+            return
+        with self.lock:
+            stall = watched.stall
+            if stall is not None:
+                stall.gap = t - stall.started
+                stall.ongoing = False
+                watched.stall = None
+            watched.last_beat = t
+
+    def forget(self, name):
+        # For threads that stop ticking on purpose, e.g. a receiver whose external clock went away
+        watched = self.watched.pop(name, None)
+        if watched:
+            with self.lock:
+                if watched.stall:
+                    watched.stall.ongoing = False
+
+    def run(self):
+        while True:
+            time.sleep(self.threshold / 4)
+            now = time.perf_counter()
+            for name, watched in list(self.watched.items()):
+                with self.lock:
+                    last_beat = watched.last_beat
+                    stall = watched.stall
+                    if stall is not None:
+                        stall.gap = now - last_beat
+                        continue
+                if now - last_beat <= self.threshold:
+                    continue
+                # Captured outside the lock so the stalled thread's next beat is not held up by it
+                stacks = self.capture_stacks()
+                with self.lock:
+                    # The thread may have beaten again while the stacks were captured
+                    if watched.stall is None and watched.last_beat == last_beat:
+                        watched.stall = Stall(name, last_beat, now - last_beat, stacks)
+                        self.stalls.append(watched.stall)
+
+    def capture_stacks(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        return {
+            names.get(ident, str(ident)): ''.join(traceback.format_stack(frame))
+            for ident, frame in sys._current_frames().items()
+            if ident != self.ident
+        }
+
+    def get_worst(self, top=10):
+        with self.lock:
+            stalls = list(self.stalls)
+        return sorted(stalls, key=lambda x: -x.gap)[:top]
+
+    def dump(self, f=None, top=10):
+        f = f or sys.stdout
+        stalls = self.get_worst(top)
+        f.write(f'{len(stalls)} worst of {len(self.stalls)} recorded stalls over {self.threshold * 1000:.0f} ms\n')
+        for stall in stalls:
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stall.wall_time))
+            f.write(f'\n{stall.name}: {stall.gap * 1000:.1f} ms{" and counting" if stall.ongoing else ""} at {when}\n')
+            for thread, stack in stall.stacks.items():
+                f.write(f'  Thread {thread}:\n')
+                f.write(''.join(f'    {line}\n' for line in stack.rstrip().split('\n')))
+
+    def dump_to_file(self, path, top=10):
+        with open(path, 'w') as f:
+            self.dump(f, top=top)
+        print(f'Wrote {min(top, len(self.stalls))} stalls to {path}')
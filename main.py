@@ -1,8 +1,67 @@
 #!/usr/bin/env python
-import pygame
+import time
+started = time.monotonic()
 
-from lb.app import App
+import argparse  # noqa: E402
 
-pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=256)
+from lb.boot import BootTimeline  # noqa: E402
+from lb.gpio import MCP23017GPIO  # noqa: E402
+from lb.runtime import Runtime  # noqa: E402
 
-App()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--framebuffer', metavar='PATH', help='push frames to this framebuffer device (e.g. /dev/fb1) instead of a window')
+    parser.add_argument('--mcp-interrupt-pin', metavar='PIN', type=int, help='wiringPi pin wired to the MCP23017 INTA line')
+    parser.add_argument('--journal', metavar='PATH', help='record controls, MIDI input and output to this journal file')
+    parser.add_argument('--gc-freeze', action='store_true', help='move everything allocated at startup out of the garbage collector')
+    parser.add_argument('--gc-defer', action='store_true', help='disable automatic garbage collection and collect at bar boundaries instead')
+    parser.add_argument('--realtime-priority', metavar='PRIO', type=int, help='run the engine loop and controls threads with this SCHED_FIFO priority')
+    parser.add_argument('--cpus', metavar='N', type=int, nargs='+', help='pin the engine loop and controls threads to these CPUs')
+    parser.add_argument('--watchdog', metavar='MS', type=float, help='capture all thread stacks when the clock or a MIDI clock receiver stalls this long; SIGUSR1 writes the worst stalls to stalls.txt')
+    parser.add_argument('--runtime-report', metavar='SECONDS', type=float, help='periodically print GC pause and clock latency statistics')
+    parser.add_argument('--split', action='store_true', help='run the MIDI engine in its own process, apart from the display and controls')
+    parser.add_argument('--control-socket', metavar='PATH', help='accept commands and stream state changes over a UNIX socket at this path')
+    parser.add_argument('--service', action='store_true', help='run only the MIDI engine, without display, controls hardware or pygame')
+    parser.add_argument('--control-channel', metavar='CH', type=int, default=16, help='MIDI channel carrying control changes for the controls in --service mode')
+    parser.add_argument('--control-cc', metavar='CC', type=int, default=20, help='first control change number mapped onto the controls in --service mode')
+    args = parser.parse_args()
+
+    gpio = None
+    if args.mcp_interrupt_pin is not None:
+        gpio = MCP23017GPIO(interrupt_pin=args.mcp_interrupt_pin)
+
+    runtime_options = dict(
+        freeze_gc=args.gc_freeze,
+        defer_gc=args.gc_defer,
+        priority=args.realtime_priority,
+        cpus=args.cpus,
+        report_interval=args.runtime_report,
+        watchdog=args.watchdog / 1000 if args.watchdog else None,
+    )
+
+    if args.split:
+        from lb.split import run_split
+        # With --cpus the engine process gets those CPUs to itself and the UI runs on the rest
+        run_split(framebuffer=args.framebuffer, gpio=gpio, journal=args.journal, runtime_options=runtime_options, control_socket=args.control_socket)
+        return
+
+    if args.service:
+        from lb.service import run_service
+        run_service(journal=args.journal, runtime_options=runtime_options, control_channel=args.control_channel, first_cc=args.control_cc, control_socket=args.control_socket, boot=BootTimeline(started, report=True))
+        return
+
+    def init_mixer():
+        import pygame
+        pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=256)
+
+    # The audio device comes up while the engine and the saved state load, see App for the other boot steps
+    boot = BootTimeline(started, report=True)
+    boot.start('mixer', init_mixer)
+    with boot.phase('imports'):
+        from lb.app import App
+    App(framebuffer=args.framebuffer, gpio=gpio, journal=args.journal, runtime=Runtime(**runtime_options), control_socket=args.control_socket, boot=boot)
+
+
+if __name__ == '__main__':
+    main()